@@ -4,6 +4,10 @@ import flet
 
 from libraries import *
 import chess_engine
+import bitboard
+import book
+import tablebase
+import gamedb
 
 
 class Application:
@@ -233,6 +237,10 @@ class Application:
         _page: flet.Page
         pieces: list[Application.Scene._Piece]
         cell_size: int
+        search_stats_text: flet.Text
+        thinking_indicator: flet.Row
+        # Games listed by the Load Game menu, the newest ones
+        _saved_games_shown: int = 8
 
         def __init__(self, application: Application, size: tuple[int, int] = (800, 600)):
             def app_function(page: flet.Page):
@@ -418,11 +426,12 @@ class Application:
                                 flet.Column(controls=[
                                     flet.Container(height=save_label_padding[0]),
                                     checkboxes := flet.Column(controls=[
-                                        flet.Checkbox(label="Game #1", on_change=press_checkbox, shape=flet.StadiumBorder()),
-                                        flet.Checkbox(label="Game #2", on_change=press_checkbox, shape=flet.StadiumBorder()),
-                                        flet.Checkbox(label="Game #3", on_change=press_checkbox, shape=flet.StadiumBorder()),
-                                        flet.Checkbox(label="Game #4", on_change=press_checkbox, shape=flet.StadiumBorder()),
-                                    ]),
+                                        flet.Checkbox(label=f"Game #{game_id}: {white or '?'} - {black or '?'} "
+                                                            f"{result or '*'}, {(plies + 1) // 2} moves",
+                                                      data=game_id, on_change=press_checkbox, shape=flet.StadiumBorder())
+                                        for game_id, white, black, result, date, plies in
+                                        self._application._game_db.recent(self._saved_games_shown)
+                                    ] or [flet.Text("No saved games")]),
                                     flet.Container(height=save_label_padding[2]),
                                 ]),
                                 flet.Container(width=save_label_padding[1]),
@@ -434,7 +443,9 @@ class Application:
                         start_game_button := flet.Button(
                             disabled=True,
                             content=flet.Text("Start Game"),
-                            on_click=lambda _: print("START LOADED GAME"),
+                            on_click=lambda _: (self._application.chess_engine_load_game(
+                                [checkbox.data for checkbox in checkboxes.controls if checkbox.value][0]),
+                                self._show_scene_chess()),
                             width=100,
                             style=flet.ButtonStyle(
                                 shape=flet.RoundedRectangleBorder(radius=9),
@@ -599,11 +610,11 @@ class Application:
                         on_click=newgame_call,
                         style=flet.ButtonStyle(shape=flet.RoundedRectangleBorder(radius=10)),
                     ),
-                    # main_loadgame_button := flet.Button(
-                    #     content=flet.Text("Load Game", text_align=flet.TextAlign.CENTER, size=30), height=60, width=250,
-                    #     on_click=loadgame_call,
-                    #     style=flet.ButtonStyle(shape=flet.RoundedRectangleBorder(radius=10)),
-                    # ),
+                    main_loadgame_button := flet.Button(
+                        content=flet.Text("Load Game", text_align=flet.TextAlign.CENTER, size=30), height=60, width=250,
+                        on_click=loadgame_call,
+                        style=flet.ButtonStyle(shape=flet.RoundedRectangleBorder(radius=10)),
+                    ),
                     main_settings_button := flet.Button(
                         content=flet.Text("Settings", text_align=flet.TextAlign.CENTER, size=30), height=60, width=250,
                         on_click=settings_call,
@@ -627,6 +638,8 @@ class Application:
             self._page.controls.append(menu)
 
         def _show_scene_mainmenu(self):
+            self._application.pc_move_cancel()
+            self._application.save_game()
             self._page.clean()
             self._add_scene_mainmenu()
             self._page.update()
@@ -686,7 +699,8 @@ class Application:
                     piece_current.update()
                     return
                 if piece_current.is_empty: return
-                if piece_current.board_piece.color != self.current_color:
+                if piece_current.board_piece.color != self.current_color or \
+                        self._application.is_pc_color(self.current_color):
                     piece_current.content_feedback.opacity = 0
                     piece_current.content_when_dragging.opacity = 1
                     piece_current.update()
@@ -797,6 +811,9 @@ class Application:
 
             def change_color():
                 self.current_color = chess_engine.Color.invert(self.current_color)
+                show_current_color()
+
+            def show_current_color():
                 for piece in self.pieces:
                     piece: Piece
                     if piece.is_empty: continue
@@ -881,7 +898,7 @@ class Application:
                     ]
                 ))
 
-            def piece_accept(cell: Cell):
+            def piece_accept(cell: Cell, engine_move: bool = True, promote_to: str | None = None):
                 if self.shift_pressed:
                     self.board_stack.free_layer_save()
                     self.shift_pressed = False
@@ -892,10 +909,14 @@ class Application:
 
                 piece_prev = get_piece_by_pos(transform_to_engine(cell.i, cell.j))
                 self.pieces.remove(piece_prev)
-                captured, bool_castling, bool_promotion = self._application._chess_engine.move_chessman(
-                    transform_to_engine(*active_piece.ij),
-                    transform_to_engine(cell.i, cell.j)
-                )
+                if engine_move:
+                    captured, bool_castling, bool_promotion = self._application.chess_engine_move(
+                        transform_to_engine(*active_piece.ij),
+                        transform_to_engine(cell.i, cell.j)
+                    )
+                else:
+                    # The engine has already made this move (the rook of a castling)
+                    captured, bool_castling, bool_promotion = transform_to_engine(cell.i, cell.j), False, False
                 captured = transform_from_engine(*captured)
                 # print("[]", captured)
                 # print("[]", cell.i, cell.j)
@@ -934,7 +955,7 @@ class Application:
                     pos_new = (captured[0], 5 if captured[1] == 6 else 3)
                     Cell.get_cell(*pos_new).active = True
                     rook.active = 2
-                    piece_accept(Cell.get_cell(*pos_new))
+                    piece_accept(Cell.get_cell(*pos_new), engine_move=False)
                     change_color()
 
                 if bool_promotion:
@@ -949,30 +970,69 @@ class Application:
                             ".png"
                     )
 
-                    def pick(code: str):
-                        # print("PICK")
-                        self._page.close(alert_pick_promotion)
-                        self._application._chess_engine.pawn_promotion(transform_to_engine(*pawn.ij), code)
+                    def promote(code: str):
+                        self._application.chess_engine_promotion(transform_to_engine(*pawn.ij), code)
                         pawn.board_piece = self._application._chess_engine.get_chessman(*transform_to_engine(*pawn.ij))
                         new_piece(*pawn.ij, pawn.board_piece)
                         self._page.update()
 
-                    self._page.open(alert_pick_promotion := flet.AlertDialog(
-                        modal=True,
-                        content=flet.Text("What promotion"),
-                        title=flet.Text("Confirm Exit"),
-                        actions=[
-                            flet.TextButton(content=flet.Image(src=image_src(chess_engine.ChessmanQueen, pawn), width=self.cell_size * 1.5),
-                                            on_click=lambda event: pick(chess_engine.ChessmanQueen.CODE)),
-                            flet.TextButton(content=flet.Image(src=image_src(chess_engine.ChessmanRook, pawn), width=self.cell_size * 1.5),
-                                            on_click=lambda event: pick(chess_engine.ChessmanRook.CODE)),
-                            flet.TextButton(content=flet.Image(src=image_src(chess_engine.ChessmanBishop, pawn), width=self.cell_size * 1.5),
-                                            on_click=lambda event: pick(chess_engine.ChessmanBishop.CODE)),
-                            flet.TextButton(content=flet.Image(src=image_src(chess_engine.ChessmanKnight, pawn), width=self.cell_size * 1.5),
-                                            on_click=lambda event: pick(chess_engine.ChessmanKnight.CODE)),
-                        ]
-                    ))
+                    def pick(code: str):
+                        # print("PICK")
+                        self._page.close(alert_pick_promotion)
+                        promote(code)
+                        start_pc_move()
+
+                    if promote_to is not None:
+                        # The PC has chosen already
+                        promote(promote_to)
+                    else:
+                        self._page.open(alert_pick_promotion := flet.AlertDialog(
+                            modal=True,
+                            content=flet.Text("What promotion"),
+                            title=flet.Text("Confirm Exit"),
+                            actions=[
+                                flet.TextButton(content=flet.Image(src=image_src(chess_engine.ChessmanQueen, pawn), width=self.cell_size * 1.5),
+                                                on_click=lambda event: pick(chess_engine.ChessmanQueen.CODE)),
+                                flet.TextButton(content=flet.Image(src=image_src(chess_engine.ChessmanRook, pawn), width=self.cell_size * 1.5),
+                                                on_click=lambda event: pick(chess_engine.ChessmanRook.CODE)),
+                                flet.TextButton(content=flet.Image(src=image_src(chess_engine.ChessmanBishop, pawn), width=self.cell_size * 1.5),
+                                                on_click=lambda event: pick(chess_engine.ChessmanBishop.CODE)),
+                                flet.TextButton(content=flet.Image(src=image_src(chess_engine.ChessmanKnight, pawn), width=self.cell_size * 1.5),
+                                                on_click=lambda event: pick(chess_engine.ChessmanKnight.CODE)),
+                            ]
+                        ))
+                        return
                 # print(self._application._chess_engine)
+                if engine_move:
+                    start_pc_move()
+
+            def start_pc_move():
+                """Let the PC search its move in the background if it is on move, the scene stays responsive."""
+                board = self._application._chess_engine
+                if not self._application.is_pc_color(self.current_color) or board.is_unmoving(self.current_color):
+                    return
+                show_thinking(True)
+                self._application.pc_move_start(lambda task, rates: play_pc_move(board, rates, task.ai.stats))
+
+            def play_pc_move(board, rates: list, stats: chess_engine.SearchStats | None):
+                """Make the move found by the PC search as if it was dragged, called from the search thread."""
+                if board is not self._application._chess_engine or not rates:
+                    # The scene has been left or another game started
+                    return
+                show_thinking(False)
+                self.show_search_stats(stats)
+                _, xy_from, xy_to = rates[0]
+                for piece in self.pieces:
+                    piece.active = 0
+                get_piece_by_pos(tuple(xy_from)).active = 1
+                cell = Cell.get_cell(*transform_from_engine(*xy_to))
+                cell.active = True
+                piece_accept(cell, promote_to=chess_engine.ChessmanQueen.CODE)
+                self._application.pc_ponder_start()
+
+            def show_thinking(visible: bool):
+                self.thinking_indicator.visible = visible
+                self._page.update()
 
             def piece_will_accept(event):
                 cell: Cell = event.control
@@ -1143,9 +1203,18 @@ class Application:
                                     ))
                                 )
                             ]),
+                            thinking_indicator := flet.Row([
+                                flet.ProgressRing(width=16, height=16, stroke_width=2),
+                                flet.Text(value="PC is thinking...", size=14, weight=flet.FontWeight.W_500),
+                            ], visible=False),
+                            search_stats_text := flet.Text(
+                                value="", size=11, font_family="monospace",
+                                visible=self._application._settings.value("Search stats") == "ON"),
                         ], width=250)
                     ])
                 )
+                self.search_stats_text = search_stats_text
+                self.thinking_indicator = thinking_indicator
                 self._page.controls.append(flet.Row([
                     flet.Container(width=self.cell_size * 4.5),
                     flet.Text(value="White", style=flet.TextStyle(size=18, weight=flet.FontWeight.W_600))
@@ -1211,13 +1280,24 @@ class Application:
                             new_piece(x, y, board_piece)
                         else:
                             new_empty_piece(x, y)
-                self.current_color = chess_engine.Color.WHITE
+                # A loaded game may go on with either color
+                self.current_color = self._application._chess_engine.current_color
+                if self.current_color != chess_engine.Color.WHITE:
+                    show_current_color()
+                start_pc_move()
 
         def _show_scene_chess(self):
             self._page.clean()
             self._add_scene_chess()
             self._page.update()
 
+        def show_search_stats(self, stats: chess_engine.SearchStats | None):
+            """Debug overlay of the chess scene with the statistics of the last PC move search."""
+            if stats is None or not self.search_stats_text.visible:
+                return
+            self.search_stats_text.value = str(stats)
+            self._page.update()
+
     class KeyboardListener:
         _application: Application
         shift_pressed: bool
@@ -1269,10 +1349,31 @@ class Application:
         def __del__(self):
             self._listener.stop()
 
-    _chess_engine: chess_engine.Chessboard
+    _chess_engine: chess_engine.Chessboard | bitboard.BitboardChessboard
     _players: list[bool, bool]
     _pc_difficulty: int
     _pc_difficulty_max: int = 3
+    # Budgets of the PC move search by difficulty: (seconds, nodes)
+    _pc_budgets: dict[int, tuple[float, int]] = {1: (0.5, 5000), 2: (2.0, 40000), 3: (5.0, 200000)}
+    _pc_tt: chess_engine.TranspositionTable
+    # Processes of the PC move search, one core is left for the interface
+    _pc_workers: int = max(1, (os.cpu_count() or 1) - 1)
+    _pc_executor: concurrent.futures.ProcessPoolExecutor | None
+    _pc_book: book.OpeningBook | None
+    _pc_tablebases: tablebase.Tablebases
+    # The PC move is searched in a background thread, so the scene doesn't wait for it
+    _pc_search: chess_engine.AsyncAI
+    # The search on the player's time and the hash of the position it expects after the player's move
+    _pc_ponder: tuple[chess_engine.SearchTask, int] | None
+    # The searches are started by the scene and by the search thread (the pondering) under the lock
+    _pc_lock: threading.Lock
+    # Size of the table of the shallow search which guesses the player's reply for the pondering
+    _pc_guess_tt_mb: float = 1
+    _game_db: gamedb.GameDatabase
+    # Moves of the current game from its start position and how many of them are stored already
+    _game_moves: list[tuple]
+    _game_start_fen: str
+    _game_saved_plies: int
     _settings: Application.Settings
     _input_listener: Application.KeyboardListener
     _scene: Application.Scene
@@ -1280,20 +1381,154 @@ class Application:
     def __init__(self):
         self._players = [True, True]
         self._pc_difficulty = 1
+        self._pc_tt = chess_engine.TranspositionTable()
+        self._pc_executor = None
+        self._pc_book = book.OpeningBook() if os.path.exists(book.BOOK_FILE) else None
+        self._pc_tablebases = tablebase.Tablebases()
+        self._pc_search = chess_engine.AsyncAI()
+        self._pc_ponder = None
+        self._pc_lock = threading.Lock()
+        self._game_db = gamedb.GameDatabase()
+        self._game_moves = []
+        self._game_start_fen = chess_engine.START_FEN
+        self._game_saved_plies = 0
         self._settings = Application.Settings("settings.json")
         self._input_listener = Application.KeyboardListener(self)
         self._scene = Application.Scene(self)
 
+    def _board_class(self):
+        return bitboard.BitboardChessboard if self._settings.value("Board engine") == "Bitboard" else chess_engine.Chessboard
+
     def chess_engine_new_game(self):
-        self._chess_engine = chess_engine.Chessboard()
+        self.pc_table_clear()
+        self._chess_engine = self._board_class()()
         self._chess_engine.fill()
+        self._game_moves = []
+        self._game_start_fen = chess_engine.START_FEN
+        self._game_saved_plies = 0
+
+    def chess_engine_load_game(self, game_id: int, ply: int | None = None):
+        """Continue a stored game from the ply (its last move by default)."""
+        self.pc_table_clear()
+        headers, self._game_start_fen, moves = self._game_db.game(game_id)
+        self._chess_engine = self._game_db.load(game_id, ply, self._board_class())
+        self._game_moves = moves[:ply]
+        self._game_saved_plies = len(self._game_moves)
+
+    def chess_engine_move(self, xy_from, xy_to):
+        """Move of the scene (see move_chessman), recorded for the game database.
+           The board is changed under the lock, so the pondering never clones it halfway through a move."""
+        with self._pc_lock:
+            res = self._chess_engine.move_chessman(xy_from, xy_to)
+        self.record_move(xy_from, xy_to)
+        return res
+
+    def chess_engine_promotion(self, xy, promote_to: str):
+        with self._pc_lock:
+            self._chess_engine.pawn_promotion(xy, promote_to)
+        self.record_promotion(promote_to)
+
+    def record_move(self, xy_from, xy_to, promote_to: str | None = None):
+        self._game_moves.append((tuple(xy_from), tuple(xy_to), promote_to))
+
+    def record_promotion(self, promote_to: str):
+        xy_from, xy_to, _ = self._game_moves[-1]
+        self._game_moves[-1] = (xy_from, xy_to, promote_to)
+
+    def save_game(self):
+        """Store the current game if it has new moves, a continued game is stored as a new one."""
+        if len(self._game_moves) <= self._game_saved_plies:
+            return
+        color = self._chess_engine.current_color
+        result = "*"
+        if self._chess_engine.is_unmoving(color):
+            if not self._chess_engine.is_check(self._chess_engine.get_king_pos(color), color):
+                result = "1/2-1/2"
+            else:
+                result = "0-1" if color == chess_engine.Color.WHITE else "1-0"
+        names = {True: "Player", False: f"PC {self._pc_difficulty}"}
+        headers = {"White": names[bool(self._players[0])], "Black": names[bool(self._players[1])],
+                   "Date": time.strftime("%Y.%m.%d"), "Result": result}
+        if self._game_start_fen != chess_engine.START_FEN:
+            headers["FEN"] = self._game_start_fen
+        self._game_db.add_game(self._game_moves, headers, self._game_start_fen)
+        self._game_saved_plies = len(self._game_moves)
 
     def run(self):
         self._scene.run()
 
+    def pc_ai(self, color: int, ponder: bool = False) -> chess_engine.AI:
+        """AI of the PC player, its response time is bounded by the budget of the difficulty."""
+        time_limit, node_limit = self._pc_budgets[self._pc_difficulty]
+        if self._pc_workers > 1 and self._pc_executor is None:
+            self._pc_executor = concurrent.futures.ProcessPoolExecutor(self._pc_workers)
+        return chess_engine.AI(color, chess_engine.MAX_THINKING_DEPTH, self._pc_tt,
+                               time_limit=time_limit, node_limit=node_limit,
+                               workers=self._pc_workers, executor=self._pc_executor,
+                               collect_stats=self._settings.value("Search stats") == "ON", book=self._pc_book,
+                               tablebases=self._pc_tablebases if len(self._pc_tablebases) else None, ponder=ponder)
+
+    def is_pc_color(self, color: int) -> bool:
+        return self._players[0 if color == chess_engine.Color.WHITE else 1] is False
+
+    def pc_move_start(self, on_done: Callable):
+        """Start the search of the PC move in the current position, on_done(task, rates) gets the result.
+           If the pondering has expected this position, its search goes on instead and answers sooner."""
+        with self._pc_lock:
+            ponder, self._pc_ponder = self._pc_ponder, None
+            hit = ponder is not None and ponder[0] is self._pc_search.task and ponder[1] == self._chess_engine.hash
+            if not hit:
+                color = self._chess_engine.current_color
+                self._pc_search.start(self.pc_ai(color), self._chess_engine, on_done=on_done)
+                return
+        # Out of the lock: a search which has ended calls on_done at once, and the PC move takes the lock
+        ponder[0].ponderhit(on_done)
+
+    def pc_ponder_start(self):
+        """Search on the player's time: the PC searches the position after the reply it expects,
+           the table stays warm for the next search either way."""
+        if self._settings.value("PC pondering") != "ON":
+            return
+        # The player may move meanwhile, only a copy of the board is used
+        with self._pc_lock:
+            live = self._chess_engine
+            board = live.clone()
+        color = board.current_color
+        key = board.hash
+        legal = board.get_all_legal_moves(color)
+        if not legal:
+            return
+        entry = self._pc_tt.probe(key)
+        reply = entry[3] if entry is not None else None
+        if reply not in legal:
+            # The root moves were searched by other processes, a shallow search of the reply fills in.
+            # Its rates are from the player's side, they go to a table of its own
+            rates = chess_engine.AI(color, 2, chess_engine.TranspositionTable(self._pc_guess_tt_mb)).do(board)
+            reply = (rates[0][1], rates[0][2])
+        board.make_move(*reply)
+        if not board.get_all_legal_moves(board.current_color):
+            return
+        ai = self.pc_ai(board.current_color, ponder=True)
+        with self._pc_lock:
+            # The PC search has started already if the player has moved
+            if self._chess_engine is live and live.hash == key:
+                self._pc_ponder = (self._pc_search.start(ai, board), board.hash)
+
+    def pc_move_cancel(self):
+        with self._pc_lock:
+            self._pc_ponder = None
+            self._pc_search.cancel()
+
+    def pc_table_clear(self):
+        """Forget the positions searched by the PC: their rates are of the PC color and the game they were met in."""
+        self.pc_move_cancel()
+        self._pc_tt.clear()
+
     def change_player(self, player_id: int) -> bool:  # returns True if the operation has changed two parameters, else returns False
         if player_id not in (0, 1):
             raise ValueError(f"Can't change the player with id {player_id}. The number is supposed to be either 0 or 1.")
+        # The PC color changes either way
+        self.pc_table_clear()
         # ↓ Checks if the changing player [first] is set to player. If not, the following situation is going to be
         if not self._players[player_id]:
             self._players[player_id] = True
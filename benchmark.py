@@ -0,0 +1,130 @@
+#! -*- coding: utf-8 -*-
+from libraries import *
+from chess_engine import AI, Chessboard, TranspositionTable
+from bitboard import BitboardChessboard
+from perft import BOARD_CLASSES, REFERENCE_POSITIONS, move_name
+
+# Positions of the search benchmark: (category, FEN, depth)
+BENCHMARK_POSITIONS = {
+    "kiwipete": ("middlegame", REFERENCE_POSITIONS["kiwipete"][0], 3),
+    "middlegame": ("middlegame", REFERENCE_POSITIONS["middlegame"][0], 4),
+    "italian": ("middlegame", "r1bqk2r/pppp1ppp/2n2n2/2b1p3/2B1P3/3P1N2/PPP2PPP/RNBQK2R w KQkq - 0 1", 4),
+    "rook endgame": ("endgame", REFERENCE_POSITIONS["rook endgame"][0], 5),
+    "king and pawn": ("endgame", "8/8/4k3/8/2P5/8/3K4/8 w - - 0 1", 7),
+    "rook and pawns": ("endgame", "8/5pk1/6p1/8/8/6P1/5PK1/3R4 w - - 0 1", 5),
+    # Qxf7 is mate
+    "scholar's mate": ("tactical", "r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 0 1", 3),
+    # Rd8 is mate
+    "back rank": ("tactical", "6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1", 3),
+    "en passant": ("tactical", REFERENCE_POSITIONS["en passant"][0], 5),
+}
+
+# A run fails when the throughput drops by more than this part of the baseline
+REGRESSION_THRESHOLD = 0.1
+# Every position is searched so many times, the fastest run counts
+REPEAT = 3
+
+
+def _prepare(board_class, fen, depth):
+    """Board and AI of a search from scratch: the tables are empty for every run."""
+    Chessboard.pawn_table.clear()
+    board = board_class.from_fen(fen)
+    return board, AI(board.current_color, depth, TranspositionTable())
+
+
+def _search(board, ai):
+    start = time.perf_counter()
+    rates = ai.do(board)
+    return ai, rates, time.perf_counter() - start
+
+
+def run_position(board_class, fen, depth, memory=True, repeat=REPEAT):
+    """Search the position to the depth. Return a dict: nodes, seconds, nps, time to depth, best move, rate
+       and the peak of the memory allocated by the search in KB (from a separate run, if memory is True)."""
+    ai, rates, seconds = min((_search(*_prepare(board_class, fen, depth)) for i in range(repeat)),
+                             key=lambda run: run[2])
+    res = {"depth": depth, "nodes": ai.nodes, "seconds": seconds, "nps": ai.nodes / seconds if seconds else 0.0,
+           "time_to_depth": {str(iteration): elapsed for iteration, elapsed in ai.iteration_times.items()},
+           "best_move": move_name(rates[0][1], rates[0][2]) if rates else None,
+           "rate": rates[0][0] if rates else None,
+           "peak_memory_kb": None}
+    if memory:
+        # The allocations are traced apart from the timed runs, tracing slows the search down.
+        # The tables are allocated before, their fixed size would hide what the search allocates
+        board, ai = _prepare(board_class, fen, depth)
+        tracemalloc.start()
+        _search(board, ai)
+        res["peak_memory_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return res
+
+
+def run_suite(board_class=BitboardChessboard, depth=None, names=None, memory=True, repeat=REPEAT):
+    """Run the search benchmark, depth overrides the depths of the positions.
+       Return the JSON-ready report: the results of every position and the totals."""
+    positions = []
+    for name, (category, fen, position_depth) in BENCHMARK_POSITIONS.items():
+        if names and name not in names:
+            continue
+        res = run_position(board_class, fen, depth or position_depth, memory, repeat)
+        positions.append(dict(position=name, category=category, **res))
+    nodes = sum(res["nodes"] for res in positions)
+    seconds = sum(res["seconds"] for res in positions)
+    return {"board": board_class.__name__, "python": sys.version.split()[0], "positions": positions,
+            "total": {"nodes": nodes, "seconds": seconds, "nps": nodes / seconds if seconds else 0.0}}
+
+
+def compare(report, baseline, threshold=REGRESSION_THRESHOLD):
+    """Compare the report with the baseline one. Return the lines to print and False on a throughput regression."""
+    lines = []
+    ok = True
+    baseline_positions = {res["position"]: res for res in baseline["positions"]}
+    for res in report["positions"]:
+        old = baseline_positions.get(res["position"])
+        if old is None:
+            continue
+        change = res["nps"] / old["nps"] - 1 if old["nps"] else 0.0
+        line = f"{res['position']:<16} {old['nps']:10.0f} -> {res['nps']:10.0f} nodes/s ({change:+.1%})"
+        if res["best_move"] != old["best_move"]:
+            line += f", best move {old['best_move']} -> {res['best_move']}"
+        lines.append(line)
+    old_nps = baseline["total"]["nps"]
+    change = report["total"]["nps"] / old_nps - 1 if old_nps else 0.0
+    lines.append(f"{'total':<16} {old_nps:10.0f} -> {report['total']['nps']:10.0f} nodes/s ({change:+.1%})")
+    if change < -threshold:
+        ok = False
+        lines.append(f"REGRESSION: the throughput dropped by more than {threshold:.0%}")
+    return lines, ok
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Measure the AI search on the benchmark positions.")
+    parser.add_argument("--depth", type=int, help="search all the positions to this depth")
+    parser.add_argument("--board", choices=BOARD_CLASSES, default="Bitboard", help="the board engine to search")
+    parser.add_argument("--position", action="append", choices=BENCHMARK_POSITIONS,
+                        help="a benchmark position to run (all of them by default)")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="searches of every position, the fastest counts")
+    parser.add_argument("--no-memory", action="store_true", help="don't measure the peak memory")
+    parser.add_argument("--output", help="write the JSON report to the file instead of the standard output")
+    parser.add_argument("--baseline", help="JSON report to compare the throughput with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="the throughput drop which fails the run, a part of the baseline")
+    args = parser.parse_args(args)
+
+    report = run_suite(BOARD_CLASSES[args.board], args.depth, args.position, not args.no_memory, args.repeat)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as file:
+            lines, ok = compare(report, json.load(file), args.threshold)
+        print("\n".join(lines), file=sys.stderr)
+        if not ok:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
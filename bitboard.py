@@ -0,0 +1,656 @@
+#! -*- coding: utf-8 -*-
+from chess_engine import Color, Chessboard, EmptyCell, ChessmanPawn, ChessmanKnight, ChessmanBishop, ChessmanRook, \
+    ChessmanQueen, ChessmanKing, KNIGHT_STEPS, KING_STEPS, CASTLING_SQUARES, ZOBRIST_PIECES, ZOBRIST_CASTLING, \
+    ZOBRIST_EN_PASSANT, ZOBRIST_BLACK_TO_MOVE, PIECE_LETTERS, pawn_structure_rate, fen_to_snapshot, snapshot_to_fen
+
+# Square index is x + 8 * y, the same layout as Chessboard.board[y][x]:
+# y = 0 is the black back rank, y = 7 is the white back rank.
+
+# Piece kinds, used as indexes into the per-color bitboard lists
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+KIND_CLASSES = (ChessmanPawn, ChessmanKnight, ChessmanBishop, ChessmanRook, ChessmanQueen, ChessmanKing)
+KIND_BY_CODE = {cls.CODE: kind for kind, cls in enumerate(KIND_CLASSES)}
+KIND_LETTERS = [PIECE_LETTERS[cls.CODE] for cls in KIND_CLASSES]
+KIND_BY_LETTER = {letter: kind for kind, letter in enumerate(KIND_LETTERS)}
+# Color and kind of every letter of a snapshot
+SNAPSHOT_PIECES = {**{letter.upper(): (Color.WHITE, kind) for kind, letter in enumerate(KIND_LETTERS)},
+                   **{letter: (Color.BLACK, kind) for kind, letter in enumerate(KIND_LETTERS)}}
+NO_KIND = -1
+
+
+def _in_board(x, y):
+    return 0 <= x <= 7 and 0 <= y <= 7
+
+
+def _mask_from_steps(x, y, steps):
+    mask = 0
+    for dx, dy in steps:
+        if _in_board(x + dx, y + dy):
+            mask |= 1 << (x + dx + 8 * (y + dy))
+    return mask
+
+
+def _ray(x, y, dx, dy):
+    mask = 0
+    x, y = x + dx, y + dy
+    while _in_board(x, y):
+        mask |= 1 << (x + 8 * y)
+        x, y = x + dx, y + dy
+    return mask
+
+
+KNIGHT_ATTACKS = [_mask_from_steps(sq % 8, sq // 8, KNIGHT_STEPS) for sq in range(64)]
+KING_ATTACKS = [_mask_from_steps(sq % 8, sq // 8, KING_STEPS) for sq in range(64)]
+# Squares attacked by a pawn of the color standing on the square (white pawns move to y - 1)
+PAWN_ATTACKS = {
+    Color.WHITE: [_mask_from_steps(sq % 8, sq // 8, ((-1, -1), (1, -1))) for sq in range(64)],
+    Color.BLACK: [_mask_from_steps(sq % 8, sq // 8, ((-1, 1), (1, 1))) for sq in range(64)],
+}
+PAWN_STEP = {Color.WHITE: -8, Color.BLACK: 8}
+PAWN_START_ROW = {Color.WHITE: 6, Color.BLACK: 1}
+PAWN_LAST_ROW = {Color.WHITE: 0, Color.BLACK: 7}
+
+# Sliding rays. "Positive" rays go towards higher square indexes, so the nearest blocker is the lowest bit,
+# for "negative" rays it is the highest bit.
+ROOK_RAYS_POSITIVE = [[_ray(sq % 8, sq // 8, dx, dy) for sq in range(64)] for dx, dy in ((1, 0), (0, 1))]
+ROOK_RAYS_NEGATIVE = [[_ray(sq % 8, sq // 8, dx, dy) for sq in range(64)] for dx, dy in ((-1, 0), (0, -1))]
+BISHOP_RAYS_POSITIVE = [[_ray(sq % 8, sq // 8, dx, dy) for sq in range(64)] for dx, dy in ((-1, 1), (1, 1))]
+BISHOP_RAYS_NEGATIVE = [[_ray(sq % 8, sq // 8, dx, dy) for sq in range(64)] for dx, dy in ((-1, -1), (1, -1))]
+
+def _between(a, b):
+    ax, ay, bx, by = a % 8, a // 8, b % 8, b // 8
+    dx, dy = bx - ax, by - ay
+    if a == b or not (dx == 0 or dy == 0 or abs(dx) == abs(dy)):
+        return 0
+    dx, dy = (dx > 0) - (dx < 0), (dy > 0) - (dy < 0)
+    mask = 0
+    x, y = ax + dx, ay + dy
+    while (x, y) != (bx, by):
+        mask |= 1 << (x + 8 * y)
+        x, y = x + dx, y + dy
+    return mask
+
+
+# Squares strictly between two squares on the same line (0 if they aren't on one line)
+BETWEEN = [[_between(a, b) for b in range(64)] for a in range(64)]
+ALL_SQUARES = (1 << 64) - 1
+SQUARE_XY = [(sq % 8, sq // 8) for sq in range(64)]
+
+FILE_MASKS = [sum(1 << (x + 8 * y) for y in range(8)) for x in range(8)]
+
+# Castling: king square -> (rook square, squares that must be empty, squares the king passes, king target)
+CASTLING = {
+    4 + 8 * y: (
+        (7 + 8 * y, (1 << (5 + 8 * y)) | (1 << (6 + 8 * y)), (4 + 8 * y, 5 + 8 * y), 6 + 8 * y),
+        (0 + 8 * y, (1 << (1 + 8 * y)) | (1 << (2 + 8 * y)) | (1 << (3 + 8 * y)), (4 + 8 * y, 3 + 8 * y), 2 + 8 * y),
+    )
+    for y in (0, 7)
+}
+# Squares of kings and rooks in the start position, i.e. the pieces having the "not_moved" flag
+START_UNMOVED = sum(1 << sq for sq in (0, 4, 7, 56, 60, 63))
+
+# Unmoved king and rook squares giving each castling right (bits of Chessboard.castling_rights)
+CASTLING_RIGHT_MASKS = [(1 << (king[0] + 8 * king[1])) | (1 << (rook[0] + 8 * rook[1])) for king, rook in CASTLING_SQUARES]
+# Zobrist keys of the pieces by kind, shared with Chessboard so both boards hash a position the same way
+ZOBRIST_KINDS = {color: [ZOBRIST_PIECES[KIND_CLASSES[kind].CODE][color] for kind in range(6)]
+                 for color in (Color.BLACK, Color.WHITE)}
+
+# Board rating of a single piece, taken from the Chessman.rate methods
+RATE_TABLE = {
+    color: [[KIND_CLASSES[kind](color).rate(None, sq % 8, sq // 8) for sq in range(64)] for kind in range(6)]
+    for color in (Color.BLACK, Color.WHITE)
+}
+
+
+def rook_attacks(sq, occupied):
+    """Squares attacked along ranks and files from sq with the given occupancy."""
+    res = 0
+    for rays in ROOK_RAYS_POSITIVE:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        res |= ray
+    for rays in ROOK_RAYS_NEGATIVE:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        res |= ray
+    return res
+
+
+def bishop_attacks(sq, occupied):
+    """Squares attacked along diagonals from sq with the given occupancy."""
+    res = 0
+    for rays in BISHOP_RAYS_POSITIVE:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        res |= ray
+    for rays in BISHOP_RAYS_NEGATIVE:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        res |= ray
+    return res
+
+
+def iterate_bits(bb):
+    """Yield square indexes of all set bits."""
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+# Chessboard built on 64-bit integer bitboards
+class BitboardChessboard(object):
+    """Same public API as Chessboard, the position is kept as one bitboard per color and piece kind."""
+    SPACE_COLOR_WHITE = Chessboard.SPACE_COLOR_WHITE
+    SPACE_COLOR_BLACK = Chessboard.SPACE_COLOR_BLACK
+    # Debug: check the running sums against a full rescan of the board in rate()
+    VALIDATE_RATE = False
+    # Number of clone() calls, for the search statistics
+    clones = 0
+    # Pawn structure rates, the same table as of Chessboard
+    pawn_table = Chessboard.pawn_table
+
+    def __init__(self):
+        self.bitboards = {Color.BLACK: [0] * 6, Color.WHITE: [0] * 6}
+        self.occupancy = {Color.BLACK: 0, Color.WHITE: 0}
+        # Mailbox copy of the position for the per-square queries
+        self.colors = [Color.EMPTY] * 64
+        self.kinds = [NO_KIND] * 64
+        # Squares of kings and rooks which haven't moved yet (the "not_moved" flags)
+        self.unmoved = 0
+        self.chessman_en_passant = None
+        # Color to make the next move
+        self.current_color = Color.WHITE
+        # Moves since the last capture or pawn move, and the number of the full move (as in FEN)
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        # Zobrist hash of the position, pieces are hashed in _put/_remove
+        self.hash = 0
+        # Running sum of the chessman rates by color and the Zobrist hash of the pawns, also kept in _put/_remove
+        self.piece_rates = {Color.BLACK: 0, Color.WHITE: 0}
+        self.pawn_hash = 0
+
+    def fill(self):
+        """Set up a starting position on the board."""
+        self.__init__()
+        back_rank = (ROOK, KNIGHT, BISHOP, QUEEN, KING, BISHOP, KNIGHT, ROOK)
+        for x in range(8):
+            self._put(x, Color.BLACK, back_rank[x])
+            self._put(x + 8, Color.BLACK, PAWN)
+            self._put(x + 48, Color.WHITE, PAWN)
+            self._put(x + 56, Color.WHITE, back_rank[x])
+        self.unmoved = START_UNMOVED
+        self.chessman_en_passant = None
+        self.current_color = Color.WHITE
+        self.hash = self.compute_hash()
+
+    def castling_rights(self):
+        """Bitmask of the castling rights (see CASTLING_SQUARES) taken from the unmoved squares."""
+        unmoved = self.unmoved
+        rights = 0
+        for i, mask in enumerate(CASTLING_RIGHT_MASKS):
+            if unmoved & mask == mask:
+                rights |= 1 << i
+        return rights
+
+    def compute_hash(self):
+        """Compute the Zobrist hash of the position from scratch."""
+        res = 0
+        for sq in range(64):
+            if self.colors[sq] != Color.EMPTY:
+                res ^= ZOBRIST_KINDS[self.colors[sq]][self.kinds[sq]][sq]
+        res ^= ZOBRIST_CASTLING[self.castling_rights()]
+        if self.chessman_en_passant is not None:
+            res ^= ZOBRIST_EN_PASSANT[self.chessman_en_passant[0]]
+        if self.current_color == Color.BLACK:
+            res ^= ZOBRIST_BLACK_TO_MOVE
+        return res
+
+    def _put(self, sq, color, kind):
+        bit = 1 << sq
+        self.hash ^= ZOBRIST_KINDS[color][kind][sq]
+        self.piece_rates[color] += RATE_TABLE[color][kind][sq]
+        if kind == PAWN:
+            self.pawn_hash ^= ZOBRIST_KINDS[color][PAWN][sq]
+        self.bitboards[color][kind] |= bit
+        self.occupancy[color] |= bit
+        self.colors[sq] = color
+        self.kinds[sq] = kind
+
+    def _remove(self, sq):
+        color = self.colors[sq]
+        if color == Color.EMPTY:
+            return
+        bit = 1 << sq
+        self.hash ^= ZOBRIST_KINDS[color][self.kinds[sq]][sq]
+        self.piece_rates[color] -= RATE_TABLE[color][self.kinds[sq]][sq]
+        if self.kinds[sq] == PAWN:
+            self.pawn_hash ^= ZOBRIST_KINDS[color][PAWN][sq]
+        self.bitboards[color][self.kinds[sq]] ^= bit
+        self.occupancy[color] ^= bit
+        self.colors[sq] = Color.EMPTY
+        self.kinds[sq] = NO_KIND
+        self.unmoved &= ~bit
+
+    def clone(self):
+        """Create a copy of the chessboard."""
+        BitboardChessboard.clones += 1
+        cb = BitboardChessboard()
+        cb.bitboards = {color: bitboards[:] for color, bitboards in self.bitboards.items()}
+        cb.occupancy = dict(self.occupancy)
+        cb.colors = self.colors[:]
+        cb.kinds = self.kinds[:]
+        cb.unmoved = self.unmoved
+        cb.chessman_en_passant = self.chessman_en_passant
+        cb.current_color = self.current_color
+        cb.halfmove_clock = self.halfmove_clock
+        cb.fullmove_number = self.fullmove_number
+        cb.hash = self.hash
+        cb.piece_rates = dict(self.piece_rates)
+        cb.pawn_hash = self.pawn_hash
+        return cb
+
+    def snapshot(self):
+        """Compact copy of the position to send to other processes, the same as Chessboard.snapshot()."""
+        pieces = ''.join('.' if kind == NO_KIND else
+                         KIND_LETTERS[kind].upper() if color == Color.WHITE else KIND_LETTERS[kind]
+                         for color, kind in zip(self.colors, self.kinds))
+        return pieces, self.unmoved, self.chessman_en_passant, self.current_color
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Create a chessboard from snapshot()."""
+        pieces, unmoved, en_passant, current_color = snapshot
+        cb = cls()
+        put = cb._put
+        for sq, letter in enumerate(pieces):
+            if letter != '.':
+                put(sq, *SNAPSHOT_PIECES[letter])
+        cb.unmoved = unmoved
+        cb.chessman_en_passant = en_passant
+        cb.current_color = current_color
+        # The pieces are hashed in _put already
+        cb.hash ^= ZOBRIST_CASTLING[cb.castling_rights()]
+        if en_passant is not None:
+            cb.hash ^= ZOBRIST_EN_PASSANT[en_passant[0]]
+        if current_color == Color.BLACK:
+            cb.hash ^= ZOBRIST_BLACK_TO_MOVE
+        return cb
+
+    @classmethod
+    def from_fen(cls, fen):
+        """Create a chessboard from a FEN string."""
+        snapshot, halfmove, fullmove = fen_to_snapshot(fen)
+        cb = cls.from_snapshot(snapshot)
+        cb.halfmove_clock = halfmove
+        cb.fullmove_number = fullmove
+        return cb
+
+    def to_fen(self):
+        """FEN string of the position."""
+        return snapshot_to_fen(self.snapshot(), self.halfmove_clock, self.fullmove_number)
+
+    def get_chessman(self, x, y):
+        """Retrieve the chessman at the given coordinates."""
+        sq = x + 8 * y
+        kind = self.kinds[sq]
+        if kind == NO_KIND:
+            return EmptyCell()
+        chessman = KIND_CLASSES[kind](self.colors[sq])
+        if kind in (KING, ROOK):
+            chessman.not_moved = bool(self.unmoved >> sq & 1)
+        return chessman
+
+    def pieces(self):
+        """Chessmen on the board: [(x, y, color, code), ...]."""
+        res = []
+        occupied = self.occupancy[Color.BLACK] | self.occupancy[Color.WHITE]
+        while occupied:
+            sq = (occupied & -occupied).bit_length() - 1
+            occupied &= occupied - 1
+            res.append((sq % 8, sq // 8, self.colors[sq], KIND_CLASSES[self.kinds[sq]].CODE))
+        return res
+
+    def piece_count(self):
+        return (self.occupancy[Color.BLACK] | self.occupancy[Color.WHITE]).bit_count()
+
+    def get_positions(self, color, code):
+        """Positions of the chessmen of the color and the kind: [(x, y), ...]."""
+        return [SQUARE_XY[sq] for sq in iterate_bits(self.bitboards[color][KIND_BY_CODE[code]])]
+
+    def get_color(self, x, y):
+        """Get the color of the piece at the given coordinates."""
+        return self.colors[x + 8 * y]
+
+    def is_empty(self, x, y):
+        """Check if a cell on the board is empty."""
+        return self.colors[x + 8 * y] == Color.EMPTY
+
+    def get_king_pos(self, color):
+        """Returns the position of a king of the color"""
+        king = self.bitboards[color][KING]
+        if not king:
+            return None
+        sq = king.bit_length() - 1
+        return [sq % 8, sq // 8]
+
+    def _king_square(self, color):
+        return self.bitboards[color][KING].bit_length() - 1
+
+    def _en_passant_target(self):
+        """Square a pawn can capture "en passant" to, or None."""
+        if self.chessman_en_passant is None:
+            return None
+        x, y = self.chessman_en_passant
+        sq = x + 8 * y
+        return sq - PAWN_STEP[self.colors[sq]] if self.kinds[sq] == PAWN else None
+
+    def _attackers(self, sq, color, occupied):
+        """Bitboard of pieces of the color attacking sq with the given occupancy."""
+        pieces = self.bitboards[color]
+        return (KNIGHT_ATTACKS[sq] & pieces[KNIGHT]) | \
+            (KING_ATTACKS[sq] & pieces[KING]) | \
+            (PAWN_ATTACKS[Color.invert(color)][sq] & pieces[PAWN]) | \
+            (rook_attacks(sq, occupied) & (pieces[ROOK] | pieces[QUEEN])) | \
+            (bishop_attacks(sq, occupied) & (pieces[BISHOP] | pieces[QUEEN]))
+
+    def is_check(self, king_pos, color):
+        """Find out if there is a check or no"""
+        occupied = self.occupancy[Color.BLACK] | self.occupancy[Color.WHITE]
+        return bool(self._attackers(king_pos[0] + 8 * king_pos[1], Color.invert(color), occupied))
+
+    def _pseudo_targets(self, sq):
+        """Bitboard of squares the piece on sq can reach ignoring checks and castling."""
+        color = self.colors[sq]
+        kind = self.kinds[sq]
+        own = self.occupancy[color]
+        enemy = self.occupancy[Color.invert(color)]
+        occupied = own | enemy
+        if kind == PAWN:
+            targets = PAWN_ATTACKS[color][sq] & enemy
+            ep_target = self._en_passant_target()
+            if ep_target is not None and PAWN_ATTACKS[color][sq] >> ep_target & 1:
+                targets |= 1 << ep_target
+            step = PAWN_STEP[color]
+            # A pawn on the last rank waits for pawn_promotion and has no step forward
+            if 0 <= sq + step < 64 and not occupied >> (sq + step) & 1:
+                targets |= 1 << (sq + step)
+                if sq // 8 == PAWN_START_ROW[color] and not occupied >> (sq + 2 * step) & 1:
+                    targets |= 1 << (sq + 2 * step)
+            return targets
+        if kind == KNIGHT:
+            return KNIGHT_ATTACKS[sq] & ~own
+        if kind == BISHOP:
+            return bishop_attacks(sq, occupied) & ~own
+        if kind == ROOK:
+            return rook_attacks(sq, occupied) & ~own
+        if kind == QUEEN:
+            return (rook_attacks(sq, occupied) | bishop_attacks(sq, occupied)) & ~own
+        return KING_ATTACKS[sq] & ~own
+
+    def _is_legal(self, sq_from, sq_to):
+        """Find out if the move leaves the own king safe."""
+        color = self.colors[sq_from]
+        kind = self.kinds[sq_from]
+        captured = sq_to
+        if kind == PAWN and self.colors[sq_to] == Color.EMPTY and sq_from % 8 != sq_to % 8:
+            captured = sq_to - PAWN_STEP[color]
+        occupied = ((self.occupancy[Color.BLACK] | self.occupancy[Color.WHITE])
+                    & ~(1 << sq_from) & ~(1 << captured)) | (1 << sq_to)
+        king = sq_to if kind == KING else self._king_square(color)
+        return not (self._attackers(king, Color.invert(color), occupied) & ~(1 << captured))
+
+    def _legal_context(self, color):
+        """Find the checks and the pinned pieces of the color once per position.
+           Return 1) Square of the king
+                  2) Bitboard of the pieces giving check
+                  3) Bitboard of squares a non-king move must go to
+                  4) Pinned pieces: {square: bitboard of the pin line}"""
+        enemy = Color.invert(color)
+        own = self.occupancy[color]
+        occupied = own | self.occupancy[enemy]
+        king = self._king_square(color)
+        pieces = self.bitboards[enemy]
+        checkers = self._attackers(king, enemy, occupied)
+        if not checkers:
+            evasions = ALL_SQUARES
+        elif checkers & (checkers - 1):
+            # Double check, only the king can move
+            evasions = 0
+        else:
+            evasions = checkers | BETWEEN[king][checkers.bit_length() - 1]
+        pins = dict()
+        snipers = (rook_attacks(king, 0) & (pieces[ROOK] | pieces[QUEEN])) | \
+            (bishop_attacks(king, 0) & (pieces[BISHOP] | pieces[QUEEN]))
+        for sniper in iterate_bits(snipers):
+            blockers = BETWEEN[king][sniper] & occupied
+            if blockers and not blockers & (blockers - 1) and blockers & own:
+                pins[blockers.bit_length() - 1] = BETWEEN[king][sniper] | (1 << sniper)
+        return king, checkers, evasions, pins
+
+    def _legal_targets(self, sq, context, castling=False):
+        """Bitboard of squares the piece on sq can legally move to."""
+        king, checkers, evasions, pins = context
+        color = self.colors[sq]
+        enemy = Color.invert(color)
+        targets = self._pseudo_targets(sq)
+        if sq == king:
+            # The king can't hide behind itself from a sliding piece
+            occupied = (self.occupancy[Color.BLACK] | self.occupancy[Color.WHITE]) ^ (1 << sq)
+            res = 0
+            for to in iterate_bits(targets):
+                if not self._attackers(to, enemy, occupied):
+                    res |= 1 << to
+            if castling and not checkers and self.unmoved >> sq & 1 and sq in CASTLING:
+                for rook_sq, between, passed, king_to in CASTLING[sq]:
+                    if not self.unmoved >> rook_sq & 1 or self.kinds[rook_sq] != ROOK or \
+                            self.colors[rook_sq] != color or between & occupied:
+                        continue
+                    if self._attackers(passed[1], enemy, occupied) or self._attackers(king_to, enemy, occupied):
+                        continue
+                    res |= 1 << king_to
+            return res
+        res = targets & evasions & pins.get(sq, ALL_SQUARES)
+        if self.kinds[sq] == PAWN:
+            ep_target = self._en_passant_target()
+            if ep_target is not None and targets >> ep_target & 1:
+                # "En passant" removes two pieces from the line, check it on the changed occupancy
+                res &= ~(1 << ep_target)
+                if self._is_legal(sq, ep_target):
+                    res |= 1 << ep_target
+        return res
+
+    def get_chessman_moves(self, x, y):
+        """Get all valid moves for the chessman at the given position."""
+        sq = x + 8 * y
+        if self.colors[sq] == Color.EMPTY:
+            return []
+        targets = self._legal_targets(sq, self._legal_context(self.colors[sq]))
+        return [[to % 8, to // 8] for to in iterate_bits(targets)]
+
+    def get_legal_moves(self, x, y):
+        """Get all valid moves for the chessman at the given position, including castling."""
+        sq = x + 8 * y
+        if self.colors[sq] == Color.EMPTY:
+            return []
+        targets = self._legal_targets(sq, self._legal_context(self.colors[sq]), castling=True)
+        return [[to % 8, to // 8] for to in iterate_bits(targets)]
+
+    def get_all_legal_moves(self, color):
+        """Get all valid moves of the color, including castling, as (xy_from, xy_to) pairs."""
+        context = self._legal_context(color)
+        res = []
+        for sq in iterate_bits(self.occupancy[color]):
+            xy_from = SQUARE_XY[sq]
+            res.extend((xy_from, SQUARE_XY[to]) for to in iterate_bits(self._legal_targets(sq, context, True)))
+        return res
+
+    def is_unmoving(self, color):
+        """Find out if the situation is stalemate/checkmate"""
+        context = self._legal_context(color)
+        for sq in iterate_bits(self.occupancy[color]):
+            if self._legal_targets(sq, context):
+                return False
+        return True
+
+    def is_checkmate(self, king_pos, color):
+        return self.is_unmoving(color) and self.is_check(king_pos, color)
+
+    def is_stalemate(self, king_pos, color):
+        return self.is_unmoving(color) and not self.is_check(king_pos, color)
+
+    def pawn_promotion(self, xy, pawn_promote_to: str | None = None):
+        sq = xy[0] + 8 * xy[1]
+        if pawn_promote_to not in KIND_BY_CODE or self.kinds[sq] != PAWN:
+            return
+        color = self.colors[sq]
+        self._remove(sq)
+        self._put(sq, color, KIND_BY_CODE[pawn_promote_to])
+
+    def make_move(self, xy_from, xy_to, promote_to: str | None = ChessmanQueen.CODE):
+        """Make a full move in place (en passant, castling with the rook, pawn promotion to promote_to).
+           Return the undo record for unmake_move:
+           (from square, to square, captured square, captured color, captured kind,
+            previous en passant, previous unmoved mask, castling rook move, promoted kind, previous hash,
+            previous color, previous halfmove clock)"""
+        sq_from = xy_from[0] + 8 * xy_from[1]
+        sq_to = xy_to[0] + 8 * xy_to[1]
+        color = self.colors[sq_from]
+        kind = self.kinds[sq_from]
+        en_passant = self.chessman_en_passant
+        unmoved = self.unmoved
+        old_hash = self.hash
+        current_color = self.current_color
+        halfmove_clock = self.halfmove_clock
+        rights = self.castling_rights()
+
+        # Make the "en passant" movement
+        captured = sq_to
+        if kind == PAWN and self.colors[sq_to] == Color.EMPTY and sq_from % 8 != sq_to % 8:
+            captured = sq_to - PAWN_STEP[color]
+        captured_color = self.colors[captured]
+        captured_kind = self.kinds[captured]
+        self.halfmove_clock = 0 if kind == PAWN or captured_color != Color.EMPTY else halfmove_clock + 1
+        if color == Color.BLACK:
+            self.fullmove_number += 1
+
+        # Remember if the move was appropriate for "en passant" on the next move
+        if kind == PAWN and sq_to - sq_from == 2 * PAWN_STEP[color]:
+            self.chessman_en_passant = (xy_to[0], xy_to[1])
+        else:
+            self.chessman_en_passant = None
+
+        self._remove(captured)
+        self._remove(sq_from)
+        self._put(sq_to, color, kind)
+
+        # If it's castling, make sure to move the rook too
+        castling = None
+        if kind == KING and sq_to - sq_from in (2, -2):
+            castling = (sq_to + 1, sq_to - 1) if sq_to > sq_from else (sq_to - 2, sq_to + 1)
+            self._remove(castling[0])
+            self._put(castling[1], color, ROOK)
+
+        # If it's the pawn, making the move to the final field will turn it into any figure
+        promoted = None
+        if kind == PAWN and promote_to is not None and sq_to // 8 == PAWN_LAST_ROW[color]:
+            promoted = KIND_BY_CODE[promote_to]
+            self._remove(sq_to)
+            self._put(sq_to, color, promoted)
+
+        # The rest of the hash: castling rights, "en passant" file and the color to move
+        self.hash ^= ZOBRIST_CASTLING[rights] ^ ZOBRIST_CASTLING[self.castling_rights()]
+        if en_passant is not None:
+            self.hash ^= ZOBRIST_EN_PASSANT[en_passant[0]]
+        if self.chessman_en_passant is not None:
+            self.hash ^= ZOBRIST_EN_PASSANT[self.chessman_en_passant[0]]
+        self.current_color = Color.invert(color)
+        if self.current_color != current_color:
+            self.hash ^= ZOBRIST_BLACK_TO_MOVE
+
+        return sq_from, sq_to, captured, captured_color, captured_kind, en_passant, unmoved, castling, promoted, \
+            old_hash, current_color, halfmove_clock
+
+    def unmake_move(self, undo):
+        """Take back a move made with make_move."""
+        sq_from, sq_to, captured, captured_color, captured_kind, en_passant, unmoved, castling, promoted, \
+            old_hash, current_color, halfmove_clock = undo
+        color = self.colors[sq_to]
+        kind = PAWN if promoted is not None else self.kinds[sq_to]
+        if castling is not None:
+            self._remove(castling[1])
+            self._put(castling[0], color, ROOK)
+        self._remove(sq_to)
+        self._put(sq_from, color, kind)
+        if captured_color != Color.EMPTY:
+            self._put(captured, captured_color, captured_kind)
+        self.unmoved = unmoved
+        self.chessman_en_passant = en_passant
+        self.hash = old_hash
+        self.current_color = current_color
+        self.halfmove_clock = halfmove_clock
+        if color == Color.BLACK:
+            self.fullmove_number -= 1
+
+    def move_chessman(self, xy_from, xy_to):
+        """Move a chessman from one position to another (a pawn is left for pawn_promotion).
+           Return 1) Coordinates of a captured piece
+                  2) Is the move a Castling
+                  3) Is the move a pawn promotion"""
+        undo = self.make_move(xy_from, xy_to, None)
+        sq_to, captured = undo[1], undo[2]
+        is_promotion = self.kinds[sq_to] == PAWN and sq_to // 8 == PAWN_LAST_ROW[self.colors[sq_to]]
+        return (captured % 8, captured // 8), undo[7] is not None, is_promotion
+
+    def rate(self, color):
+        """Evaluate the board for a given color from the running sum and the pawn files."""
+        res = self.pawn_table.probe(self.pawn_hash, color)
+        if res is None:
+            rates = {}
+            for pawns_color in (Color.BLACK, Color.WHITE):
+                pawns = self.bitboards[pawns_color][PAWN]
+                rates[pawns_color] = pawn_structure_rate([(pawns & mask).bit_count() for mask in FILE_MASKS])
+            self.pawn_table.store(self.pawn_hash, rates[Color.BLACK], rates[Color.WHITE])
+            res = rates[color]
+        res += self.piece_rates[color]
+        if self.VALIDATE_RATE:
+            assert res == self.rescan_rate(color), "The running sums of rate() are out of date"
+        return res
+
+    def rescan_rate(self, color):
+        """Evaluate the board for a given color piece by piece (the debug check of rate())."""
+        res = 0
+        pieces = self.bitboards[color]
+        rates = RATE_TABLE[color]
+        for kind in range(6):
+            table = rates[kind]
+            for sq in iterate_bits(pieces[kind]):
+                res += table[sq]
+        pawns = pieces[PAWN]
+        files = [(pawns & FILE_MASKS[x]).bit_count() for x in range(8)]
+        # double pawns reduce the rate
+        res += 2 * (sum(1 for count in files if count) - sum(files))
+        # alone pawn reduce the rate
+        for i in range(1, 6):
+            if files[i] and not files[i - 1] and not files[i + 1]:
+                res -= 2
+        return res
+
+    def __str__(self):
+        """Return the board's string representation."""
+        res = "  a b c d e f g h\n"
+        for y in range(8):
+            res += f"{8 - y} "  # Row numbers
+            for x in range(8):
+                color = self.SPACE_COLOR_BLACK if (x + y) % 2 else self.SPACE_COLOR_WHITE
+                res += f'\033[48;5;{color}m{self.get_chessman(x, y)} '
+            res += "\033[0m\n"
+        return res
@@ -0,0 +1,163 @@
+#! -*- coding: utf-8 -*-
+from libraries import *
+from chess_engine import ChessmanPawn
+from bitboard import BitboardChessboard
+from perft import PROMOTIONS, move_name, parse_move_name
+import pgn
+
+# The opening book of the PC player and the games it is built from
+BOOK_FILE = "resources/book.bin"
+BOOK_GAMES_FILE = "resources/openings.txt"
+# Moves of every game which go to the book
+BOOK_PLIES = 16
+# Record of the book: position hash, move, weight. The records are sorted by the hash
+RECORD = struct.Struct('<QHH')
+MAX_WEIGHT = 0xFFFF
+
+
+def encode_move(xy_from, xy_to, promote_to=None):
+    """Move in 16 bits: the squares by 6 bits and the promotion (index in PROMOTIONS + 1) above them."""
+    promotion = PROMOTIONS.index(promote_to) + 1 if promote_to is not None else 0
+    return (xy_from[0] + 8 * xy_from[1]) | (xy_to[0] + 8 * xy_to[1]) << 6 | promotion << 12
+
+
+def decode_move(code):
+    sq_from, sq_to, promotion = code & 63, code >> 6 & 63, code >> 12
+    return (sq_from % 8, sq_from // 8), (sq_to % 8, sq_to // 8), PROMOTIONS[promotion - 1] if promotion else None
+
+
+class OpeningBook(object):
+    """Read-only opening book in a memory-mapped file, the records are found by bisection.
+       Every process which opens the book shares its pages through the page cache."""
+    def __init__(self, filename=BOOK_FILE):
+        self.filename = filename
+        self.memory = None
+        with open(filename, 'rb') as file:
+            length = os.fstat(file.fileno()).st_size
+            if length % RECORD.size:
+                raise ValueError(f"{filename} is not an opening book")
+            # An empty file can't be mapped, the book is just empty then
+            if length:
+                self.memory = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = length // RECORD.size
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory = None
+
+    def entries(self, key):
+        """Book moves of the position with the hash: [(xy_from, xy_to, promote_to, weight), ...]."""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if RECORD.unpack_from(self.memory, mid * RECORD.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        res = []
+        for i in range(lo, self.size):
+            record_key, code, weight = RECORD.unpack_from(self.memory, i * RECORD.size)
+            if record_key != key:
+                break
+            res.append((*decode_move(code), weight))
+        return res
+
+    def choose(self, board, rng=random):
+        """Book move of the position picked by the weights: (xy_from, xy_to, promote_to), None out of the book.
+           Moves which aren't legal on the board (a hash collision) are skipped."""
+        legal = board.get_all_legal_moves(board.current_color)
+        moves = [entry for entry in self.entries(board.hash) if (entry[0], entry[1]) in legal]
+        if not moves:
+            return None
+        xy_from, xy_to, promote_to, weight = rng.choices(moves, [entry[3] for entry in moves])[0]
+        return xy_from, xy_to, promote_to
+
+
+def read_games(filename, plies=BOOK_PLIES):
+    """Games of a file as lists of move names: a PGN file (*.pgn) or a text file with one game per line
+       in coordinate notation (e2e4 e7e5 ...), # starts a comment. PGN games with illegal moves are skipped."""
+    if filename.lower().endswith('.pgn'):
+        for game in pgn.read_games(filename):
+            if 'FEN' in game.headers:
+                continue
+            moves = []
+            try:
+                for ply, move, board in game.replay():
+                    moves.append(move_name(*move))
+                    if ply >= plies:
+                        break
+            except ValueError:
+                continue
+            yield moves
+        return
+    with open(filename) as file:
+        for line in file:
+            moves = line.split('#')[0].split()
+            if moves:
+                yield moves
+
+
+def build(games, filename, plies=BOOK_PLIES, min_weight=1):
+    """Compile the book of the games (lists of move names) into the file. The weight of a move is
+       the number of games which play it in the position. Return the number of records."""
+    weights = {}
+    for number, game in enumerate(games, 1):
+        board = BitboardChessboard()
+        board.fill()
+        for name in game[:plies]:
+            xy_from, xy_to, promote_to = parse_move_name(name)
+            if (xy_from, xy_to) not in board.get_all_legal_moves(board.current_color):
+                raise ValueError(f"Game {number}: {name} is not a legal move")
+            if promote_to is None and xy_to[1] in (0, 7) and board.get_chessman(*xy_from).CODE == ChessmanPawn.CODE:
+                promote_to = 'queen'
+            key = (board.hash, encode_move(xy_from, xy_to, promote_to))
+            weights[key] = weights.get(key, 0) + 1
+            board.make_move(xy_from, xy_to, promote_to)
+    records = sorted((key, code, min(weight, MAX_WEIGHT))
+                     for (key, code), weight in weights.items() if weight >= min_weight)
+    with open(filename, 'wb') as file:
+        for record in records:
+            file.write(RECORD.pack(*record))
+    return len(records)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Build or look into the opening book.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="compile the book from the games")
+    build_parser.add_argument("--games", default=BOOK_GAMES_FILE,
+                              help="PGN file of the games or a text file with a game per line")
+    build_parser.add_argument("--output", default=BOOK_FILE, help="the book file to write")
+    build_parser.add_argument("--plies", type=int, default=BOOK_PLIES, help="moves of every game to take")
+    build_parser.add_argument("--min-weight", type=int, default=1, help="drop the moves played by fewer games")
+    probe_parser = commands.add_parser("probe", help="list the book moves of a position")
+    probe_parser.add_argument("--book", default=BOOK_FILE, help="the book file to read")
+    probe_parser.add_argument("moves", nargs="*", help="moves from the start position, e2e4 e7e5 ...")
+    args = parser.parse_args(args)
+
+    if args.command == "build":
+        records = build(read_games(args.games, args.plies), args.output, args.plies, args.min_weight)
+        print(f"{records} records written to {args.output}")
+        return 0
+
+    board = BitboardChessboard()
+    board.fill()
+    for name in args.moves:
+        board.make_move(*parse_move_name(name))
+    book = OpeningBook(args.book)
+    entries = book.entries(board.hash)
+    book.close()
+    total = sum(entry[3] for entry in entries)
+    for xy_from, xy_to, promote_to, weight in sorted(entries, key=lambda entry: -entry[3]):
+        print(f"{move_name(xy_from, xy_to, promote_to)}  {weight:>5}  {weight / total:.0%}")
+    if not entries:
+        print("out of the book")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,7 +4,25 @@ from libraries import *
 
 # Depth of the AI decision tree
 
-THINKING_DEPTH = 4
+THINKING_DEPTH = 3
+# Deepest iteration of a search limited by a time or node budget
+MAX_THINKING_DEPTH = 32
+# Memory budget of the AI transposition table in MB
+TT_SIZE_MB = 16
+# Memory budget of the pawn structure table in MB
+PAWN_TABLE_SIZE_MB = 1
+
+# Steps of the jumping pieces and directions of the sliding pieces: (dx, dy) pairs
+KNIGHT_STEPS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+KING_STEPS = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+ROOK_DIRECTIONS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+BISHOP_DIRECTIONS = ((-1, -1), (1, -1), (-1, 1), (1, 1))
+
+# Castling rights bits: (king position, rook position) - white short, white long, black short, black long
+CASTLING_SQUARES = (((4, 7), (7, 7)), ((4, 7), (0, 7)), ((4, 0), (7, 0)), ((4, 0), (0, 0)))
+
+# Letters of the chessmen in board snapshots, upper case for white
+PIECE_LETTERS = {'pawn': 'p', 'knight': 'n', 'bishop': 'b', 'rook': 'r', 'queen': 'q', 'king': 'k'}
 
 # Define colors for pieces
 class Color(object):
@@ -19,6 +37,138 @@ class Color(object):
             return color
         return cls.BLACK if color == cls.WHITE else cls.WHITE
 
+# Random keys of the Zobrist position hash. The seed is fixed, so the hash of a position is the same
+# in every process and for every board class.
+_zobrist_random = random.Random(20241105)
+ZOBRIST_PIECES = {code: {color: [_zobrist_random.getrandbits(64) for sq in range(64)]
+                         for color in (Color.BLACK, Color.WHITE)}
+                  for code in ('pawn', 'knight', 'bishop', 'rook', 'queen', 'king')}
+ZOBRIST_CASTLING = [0] + [_zobrist_random.getrandbits(64) for rights in range(1, 16)]
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for x in range(8)]
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+
+def pawn_structure_rate(files):
+    """Rate of the pawn structure by the numbers of pawns on the files a..h."""
+    # double pawns reduce the rate
+    res = 2 * (sum(1 for count in files if count) - sum(files))
+    # alone pawn reduce the rate
+    for i in range(1, 6):
+        if files[i] and not files[i - 1] and not files[i + 1]:
+            res -= 2
+    return res
+
+
+# Fixed-size cache of the pawn structure rates
+class PawnHashTable(object):
+    """Entries are keyed by the Zobrist hash of the pawns only (Chessboard.pawn_hash) and keep the pawn structure
+       rates of both colors. A new entry replaces the old one in its slot."""
+    # Bytes per entry: key and the rates of black and white
+    ENTRY_SIZE = 24
+
+    def __init__(self, size_mb=PAWN_TABLE_SIZE_MB):
+        self.size_mb = size_mb
+        self.size = max(1, int(size_mb * 1024 * 1024) // self.ENTRY_SIZE)
+        self.keys = array.array('Q', bytes(8 * self.size))
+        self.rates = {Color.BLACK: array.array('q', bytes(8 * self.size)),
+                      Color.WHITE: array.array('q', bytes(8 * self.size))}
+        # The key of a position without pawns is 0, so the used slots are marked apart
+        self.used = bytearray(self.size)
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Forget all the pawn structures and reset the counters."""
+        self.__init__(self.size_mb)
+
+    def hit_rate(self):
+        """Part of the probes answered from the table."""
+        probes = self.hits + self.misses
+        return self.hits / probes if probes else 0.0
+
+    def probe(self, key, color):
+        """Return the pawn structure rate of the color, or None."""
+        i = key % self.size
+        if self.used[i] and self.keys[i] == key:
+            self.hits += 1
+            return self.rates[color][i]
+        self.misses += 1
+        return None
+
+    def store(self, key, black_rate, white_rate):
+        """Save the pawn structure rates of both colors."""
+        i = key % self.size
+        self.keys[i] = key
+        self.rates[Color.BLACK][i] = black_rate
+        self.rates[Color.WHITE][i] = white_rate
+        self.used[i] = 1
+
+
+# FEN: the castling letters in the order of CASTLING_SQUARES and the start position
+FEN_CASTLING = tuple(zip('KQkq', [(king[0] + 8 * king[1], rook[0] + 8 * rook[1]) for king, rook in CASTLING_SQUARES]))
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+# str.replace of the digits is faster than str.translate to strings of several characters
+_FEN_DIGITS = [(str(n), '.' * n) for n in range(1, 9)]
+_FEN_PIECES = str.maketrans('', '', 'pnbrqkPNBRQK.')
+_FEN_RUNS = [('.' * n, str(n)) for n in range(8, 0, -1)]
+# Squares of the castling kings and rooks, and the castling field by the not moved mask of those squares
+_FEN_CASTLING_MASK = sum(1 << sq for sq in {sq for letter, squares in FEN_CASTLING for sq in squares})
+_FEN_CASTLING_TEXT = {}
+
+
+def _fen_castling(unmoved):
+    text = ''.join(letter for letter, (king, rook) in FEN_CASTLING if unmoved >> king & 1 and unmoved >> rook & 1)
+    _FEN_CASTLING_TEXT[unmoved] = text or '-'
+    return text or '-'
+
+
+def fen_to_snapshot(fen):
+    """Board snapshot (see Chessboard.snapshot) and the move counters of a FEN string:
+       (snapshot, halfmove clock, fullmove number). Raise ValueError if it isn't one."""
+    fields = fen.split()
+    if len(fields) not in (4, 6) or fields[0].count('/') != 7 or fields[1] not in ('w', 'b'):
+        raise ValueError(f"Not a FEN: {fen!r}")
+    pieces = fields[0]
+    for digit, run in _FEN_DIGITS:
+        if digit in pieces:
+            pieces = pieces.replace(digit, run)
+    pieces = pieces.replace('/', '')
+    if len(pieces) != 64 or pieces.translate(_FEN_PIECES):
+        raise ValueError(f"Not a FEN: {fen!r}")
+    color = Color.WHITE if fields[1] == 'w' else Color.BLACK
+    # Castling rights are the not moved kings and rooks, only if they stand on their squares
+    unmoved = 0
+    if fields[2] != '-':
+        for letter, (king, rook) in FEN_CASTLING:
+            if letter in fields[2] and pieces[king] == ('K' if letter.isupper() else 'k') and \
+                    pieces[rook] == ('R' if letter.isupper() else 'r'):
+                unmoved |= 1 << king | 1 << rook
+    # The en passant target is the square passed by the pawn, the snapshot keeps the pawn itself
+    en_passant = None
+    target = fields[3]
+    if target != '-':
+        if len(target) != 2 or target[0] not in 'abcdefgh' or target[1] not in '36':
+            raise ValueError(f"Not a FEN: {fen!r}")
+        en_passant = ('abcdefgh'.index(target[0]), 4 if target[1] == '3' else 3)
+        if pieces[en_passant[0] + 8 * en_passant[1]] != ('P' if target[1] == '3' else 'p'):
+            en_passant = None
+    halfmove, fullmove = (int(fields[4]), int(fields[5])) if len(fields) == 6 else (0, 1)
+    return (pieces, unmoved, en_passant, color), halfmove, fullmove
+
+
+def snapshot_to_fen(snapshot, halfmove=0, fullmove=1):
+    """FEN string of a board snapshot with the move counters."""
+    pieces, unmoved, en_passant, color = snapshot
+    placement = '/'.join([pieces[0:8], pieces[8:16], pieces[16:24], pieces[24:32],
+                          pieces[32:40], pieces[40:48], pieces[48:56], pieces[56:64]])
+    for run, digit in _FEN_RUNS:
+        if run in placement:
+            placement = placement.replace(run, digit)
+    unmoved &= _FEN_CASTLING_MASK
+    castling = _FEN_CASTLING_TEXT.get(unmoved) or _fen_castling(unmoved)
+    target = '-' if en_passant is None else 'abcdefgh'[en_passant[0]] + ('3' if en_passant[1] == 4 else '6')
+    return f"{placement} {'w' if color == Color.WHITE else 'b'} {castling} {target} {halfmove} {fullmove}"
+
+
 # Chessboard class to manage the board and gameplay
 class Chessboard(object):
     SPACE_COLOR_WHITE = 209
@@ -27,6 +177,26 @@ class Chessboard(object):
     #Dark square color code
 
     board = None
+    # Color to make the next move
+    current_color = Color.WHITE
+    # Zobrist hash of the position, updated on every move
+    hash = 0
+    # Moves since the last capture or pawn move, and the number of the full move (as in FEN)
+    halfmove_clock = 0
+    fullmove_number = 1
+    # Running sums of rate(): the chessman rates and the pawns on every file, by color
+    piece_rates = None
+    pawn_files = None
+    # Zobrist hash of the pawns only, the key of pawn_table
+    pawn_hash = 0
+    # Chessmen on the board, the captures take them off
+    pieces_left = 0
+    # Pawn structure rates, shared by all the boards
+    pawn_table = PawnHashTable()
+    # Debug: check the running sums against a full rescan of the board in rate()
+    VALIDATE_RATE = False
+    # Number of clone() calls, for the search statistics
+    clones = 0
 
     def fill(self):
         """Set up a starting position on the board."""
@@ -59,6 +229,37 @@ class Chessboard(object):
             board[6][x] = ChessmanPawn(white)
 
         self.chessman_en_passant = None
+        self.current_color = white
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        self.hash = self.compute_hash()
+        self.reset_rates()
+
+    def castling_rights(self):
+        """Bitmask of the castling rights (see CASTLING_SQUARES) taken from the not_moved flags."""
+        rights = 0
+        for i, (king_xy, rook_xy) in enumerate(CASTLING_SQUARES):
+            king = self.board[king_xy[1]][king_xy[0]]
+            rook = self.board[rook_xy[1]][rook_xy[0]]
+            if king.CODE == ChessmanKing.CODE and king.not_moved and \
+                    rook.CODE == ChessmanRook.CODE and rook.not_moved and rook.color == king.color:
+                rights |= 1 << i
+        return rights
+
+    def compute_hash(self):
+        """Compute the Zobrist hash of the position from scratch."""
+        res = 0
+        for y in range(8):
+            for x in range(8):
+                chessman = self.board[y][x]
+                if chessman.color != Color.EMPTY:
+                    res ^= ZOBRIST_PIECES[chessman.CODE][chessman.color][x + 8 * y]
+        res ^= ZOBRIST_CASTLING[self.castling_rights()]
+        if self.chessman_en_passant is not None:
+            res ^= ZOBRIST_EN_PASSANT[self.chessman_en_passant[0]]
+        if self.current_color == Color.BLACK:
+            res ^= ZOBRIST_BLACK_TO_MOVE
+        return res
 
     def get_king_pos(self, color):
         """Returns the position of a king of the color"""
@@ -70,26 +271,100 @@ class Chessboard(object):
 
     def is_check(self, king_pos, color):
         """Find out if there is a check or no"""
-        for x in range(8):
-            for y in range(8):
-                chessman = self.get_chessman(x, y)
-                if chessman.color != Color.invert(color): continue
-                if king_pos in chessman.get_moves(self, x, y):
+        return self.is_attacked(king_pos, Color.invert(color))
+
+    def is_attacked(self, xy, color):
+        """Find out if the position is attacked by any chessman of the color"""
+        x, y = xy
+        board = self.board
+        for dx, dy in KNIGHT_STEPS:
+            i, j = x + dx, y + dy
+            if 0 <= i <= 7 and 0 <= j <= 7 and board[j][i].color == color and board[j][i].CODE == ChessmanKnight.CODE:
+                return True
+        for dx, dy in KING_STEPS:
+            i, j = x + dx, y + dy
+            if 0 <= i <= 7 and 0 <= j <= 7 and board[j][i].color == color and board[j][i].CODE == ChessmanKing.CODE:
+                return True
+        # Pawns capture towards the enemy side, so they attack from the row behind the position
+        j = y + (1 if color == Color.WHITE else -1)
+        if 0 <= j <= 7:
+            for i in (x - 1, x + 1):
+                if 0 <= i <= 7 and board[j][i].color == color and board[j][i].CODE == ChessmanPawn.CODE:
                     return True
+        for directions, codes in ((ROOK_DIRECTIONS, (ChessmanRook.CODE, ChessmanQueen.CODE)),
+                                  (BISHOP_DIRECTIONS, (ChessmanBishop.CODE, ChessmanQueen.CODE))):
+            for dx, dy in directions:
+                i, j = x + dx, y + dy
+                while 0 <= i <= 7 and 0 <= j <= 7:
+                    chessman = board[j][i]
+                    if chessman.color != Color.EMPTY:
+                        if chessman.color == color and chessman.CODE in codes:
+                            return True
+                        break
+                    i += dx
+                    j += dy
         return False
 
+    def _legal_context(self, color):
+        """Find the checks and the pinned chessmen of the color once per position.
+           Return 1) Position of the king
+                  2) Number of the chessmen giving check
+                  3) Positions a non-king move must go to (None - any position)
+                  4) Pinned chessmen: {position: positions on the pin line}"""
+        x, y = king_pos = self.get_king_pos(color)
+        enemy = Color.invert(color)
+        board = self.board
+        checkers = 0
+        evasions = None
+        pins = dict()
+        for directions, codes in ((ROOK_DIRECTIONS, (ChessmanRook.CODE, ChessmanQueen.CODE)),
+                                  (BISHOP_DIRECTIONS, (ChessmanBishop.CODE, ChessmanQueen.CODE))):
+            for dx, dy in directions:
+                line = set()
+                pinned = None
+                i, j = x + dx, y + dy
+                while 0 <= i <= 7 and 0 <= j <= 7:
+                    line.add((i, j))
+                    chessman = board[j][i]
+                    if chessman.color == color:
+                        if pinned is not None:
+                            break
+                        pinned = (i, j)
+                    elif chessman.color == enemy:
+                        if chessman.CODE in codes:
+                            if pinned is None:
+                                checkers += 1
+                                evasions = line
+                            else:
+                                pins[pinned] = line
+                        break
+                    i += dx
+                    j += dy
+        for dx, dy in KNIGHT_STEPS:
+            i, j = x + dx, y + dy
+            if 0 <= i <= 7 and 0 <= j <= 7 and board[j][i].color == enemy and board[j][i].CODE == ChessmanKnight.CODE:
+                checkers += 1
+                evasions = {(i, j)}
+        j = y + (1 if enemy == Color.WHITE else -1)
+        if 0 <= j <= 7:
+            for i in (x - 1, x + 1):
+                if 0 <= i <= 7 and board[j][i].color == enemy and board[j][i].CODE == ChessmanPawn.CODE:
+                    checkers += 1
+                    evasions = {(i, j)}
+        if checkers > 1:
+            # Double check, only the king can move
+            evasions = set()
+        return king_pos, checkers, evasions, pins
+
     def is_unmoving(self, color):
         """Find out if the situation is stalemate/checkmate"""
+        context = self._legal_context(color)
         for x in range(8):
             for y in range(8):
                 chessman = self.get_chessman(x, y)
                 if chessman.color != color: continue
-                for move in chessman.get_moves(self, x, y):
-                    self_clone = self.clone()
-                    self_clone.move_chessman((x, y), move)
-                    king_pos = self_clone.get_king_pos(chessman.color)
-                    if not self_clone.is_check(king_pos, chessman.color):
-                        return False
+                if self._legal_only(x, y, chessman.get_moves(self, x, y), context):
+                    return False
         return True
 
     def is_checkmate(self, king_pos, color):
@@ -101,15 +376,87 @@ class Chessboard(object):
 
     def clone(self):
         """Create a deep copy of the chessboard."""
+        Chessboard.clones += 1
         cb = Chessboard()
         cb.board = copy.deepcopy(self.board)
         cb.chessman_en_passant = self.chessman_en_passant
+        cb.current_color = self.current_color
+        cb.halfmove_clock = self.halfmove_clock
+        cb.fullmove_number = self.fullmove_number
+        cb.hash = self.hash
+        cb.piece_rates = dict(self.piece_rates)
+        cb.pawn_files = {color: files[:] for color, files in self.pawn_files.items()}
+        cb.pawn_hash = self.pawn_hash
+        cb.pieces_left = self.pieces_left
+        return cb
+
+    def snapshot(self):
+        """Compact copy of the position to send to other processes:
+           (64 chessman letters by square, '.' for empty, mask of the not moved squares, en passant, color to move)"""
+        pieces = ''
+        unmoved = 0
+        for y in range(8):
+            for x in range(8):
+                chessman = self.board[y][x]
+                if chessman.color == Color.EMPTY:
+                    pieces += '.'
+                    continue
+                letter = PIECE_LETTERS[chessman.CODE]
+                pieces += letter.upper() if chessman.color == Color.WHITE else letter
+                if getattr(chessman, 'not_moved', False):
+                    unmoved |= 1 << (x + 8 * y)
+        return pieces, unmoved, self.chessman_en_passant, self.current_color
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Create a chessboard from snapshot()."""
+        pieces, unmoved, en_passant, current_color = snapshot
+        cb = cls()
+        cb.board = [[EmptyCell() for x in range(8)] for y in range(8)]
+        for sq, letter in enumerate(pieces):
+            if letter == '.':
+                continue
+            chessman = CHESSMAN_CLASSES[LETTER_CODES[letter.lower()]](
+                Color.WHITE if letter.isupper() else Color.BLACK)
+            if chessman.CODE in (ChessmanKing.CODE, ChessmanRook.CODE):
+                chessman.not_moved = bool(unmoved >> sq & 1)
+            cb.board[sq // 8][sq % 8] = chessman
+        cb.chessman_en_passant = en_passant
+        cb.current_color = current_color
+        cb.hash = cb.compute_hash()
+        cb.reset_rates()
+        return cb
+
+    @classmethod
+    def from_fen(cls, fen):
+        """Create a chessboard from a FEN string."""
+        snapshot, halfmove, fullmove = fen_to_snapshot(fen)
+        cb = cls.from_snapshot(snapshot)
+        cb.halfmove_clock = halfmove
+        cb.fullmove_number = fullmove
         return cb
 
+    def to_fen(self):
+        """FEN string of the position."""
+        return snapshot_to_fen(self.snapshot(), self.halfmove_clock, self.fullmove_number)
+
     def get_chessman(self, x, y):
         """Retrieve the chessman at the given coordinates."""
         return self.board[y][x]
 
+    def pieces(self):
+        """Chessmen on the board: [(x, y, color, code), ...]."""
+        return [(x, y, chessman.color, chessman.CODE) for y, row in enumerate(self.board)
+                for x, chessman in enumerate(row) if chessman.color != Color.EMPTY]
+
+    def piece_count(self):
+        return self.pieces_left
+
+    def get_positions(self, color, code):
+        """Positions of the chessmen of the color and the kind: [(x, y), ...]."""
+        return [(x, y) for y, row in enumerate(self.board) for x, chessman in enumerate(row)
+                if chessman.color == color and chessman.CODE == code]
+
     def get_color(self, x, y):
         """Get the color of the piece at the given coordinates."""
         return self.get_chessman(x, y).color
@@ -117,18 +464,66 @@ class Chessboard(object):
     def get_chessman_moves(self, x, y):
         """Get all valid moves for the chessman at the given position."""
         chessman = self.get_chessman(x, y)
-        moves = chessman.get_moves(self, x, y)
+        return self._legal_only(x, y, chessman.get_moves(self, x, y), self._legal_context(chessman.color))
+
+    def get_legal_moves(self, x, y):
+        """Get all valid moves for the chessman at the given position, including castling."""
+        chessman = self.get_chessman(x, y)
+        moves = chessman.get_moves(self, x, y, castling=True) \
+            if chessman.CODE == ChessmanKing.CODE else \
+            chessman.get_moves(self, x, y)
+        return self._legal_only(x, y, moves, self._legal_context(chessman.color))
+
+    def get_all_legal_moves(self, color):
+        """Get all valid moves of the color, including castling, as (xy_from, xy_to) pairs."""
+        context = self._legal_context(color)
+        res = []
+        for y in range(8):
+            for x in range(8):
+                chessman = self.board[y][x]
+                if chessman.color != color:
+                    continue
+                moves = chessman.get_moves(self, x, y, castling=True) \
+                    if chessman.CODE == ChessmanKing.CODE else \
+                    chessman.get_moves(self, x, y)
+                res.extend(((x, y), (move[0], move[1])) for move in self._legal_only(x, y, moves, context))
+        return res
+
+    def _legal_only(self, x, y, moves, context):
+        """Keep the moves which don't leave the own king under check."""
+        king_pos, checkers, evasions, pins = context
+        chessman = self.board[y][x]
         moves_final = list()
+        if chessman.CODE == ChessmanKing.CODE:
+            # The king can't hide behind itself from a sliding chessman
+            self.board[y][x] = EmptyCell()
+            for move in moves:
+                if move[0] - x in (2, -2) and checkers:
+                    continue
+                if not self.is_attacked(move, chessman.enemy_color()):
+                    moves_final.append(move)
+            self.board[y][x] = chessman
+            return moves_final
+        pin_line = pins.get((x, y))
         for move in moves:
-            self_clone = self.clone()
-            self_clone.move_chessman((x, y), move)
-            king_pos = self_clone.get_king_pos(chessman.color)
-            if not self_clone.is_check(king_pos, chessman.color):
-                moves_final.append(move)
+            if chessman.CODE == ChessmanPawn.CODE and move[0] != x and self.is_empty(*move):
+                # "En passant" removes two chessmen from the line, check it by playing the move
+                undo = self.make_move((x, y), move)
+                if not self.is_check(king_pos, chessman.color):
+                    moves_final.append(move)
+                self.unmake_move(undo)
+                continue
+            xy = (move[0], move[1])
+            if evasions is not None and xy not in evasions:
+                continue
+            if pin_line is not None and xy not in pin_line:
+                continue
+            moves_final.append(move)
         return moves_final
 
     def pawn_promotion(self, xy, pawn_promote_to: str | None = None):
-        color = self.board[xy[1]][xy[0]].color
+        pawn = self.board[xy[1]][xy[0]]
+        color = pawn.color
         if pawn_promote_to == ChessmanQueen.CODE:
             self.board[xy[1]][xy[0]] = ChessmanQueen(color)
         elif pawn_promote_to == ChessmanRook.CODE:
@@ -138,44 +533,134 @@ class Chessboard(object):
             self.board[xy[1]][xy[0]] = ChessmanBishop(color)
         elif pawn_promote_to == ChessmanKnight.CODE:
             self.board[xy[1]][xy[0]] = ChessmanKnight(color)
-
-    def move_chessman(self, xy_from, xy_to):
-        """Move a chessman from one position to another.
-           Return 1) Coordinates of a captured piece
-                  2) Is the move a Castling
-                  3) Is the move a pawn promotion"""
-        captured = (xy_to[1], xy_to[0])
+        else:
+            return
+        pieces = ZOBRIST_PIECES
+        self.hash ^= pieces[pawn.CODE][color][xy[0] + 8 * xy[1]] ^ \
+            pieces[pawn_promote_to][color][xy[0] + 8 * xy[1]]
+        self._rate_add(pawn, xy[0], xy[1], -1)
+        self._rate_add(self.board[xy[1]][xy[0]], xy[0], xy[1])
+
+    def make_move(self, xy_from, xy_to, promote_to: str | None = 'queen'):
+        """Make a full move in place (en passant, castling with the rook, pawn promotion to promote_to).
+           Return the undo record for unmake_move:
+           (xy_from, xy_to, chessman, captured chessman, captured position, previous en passant,
+            previous not_moved flag, castling rook move, promoted pawn, previous hash, previous color,
+            previous halfmove clock)"""
+        chessman = self.board[xy_from[1]][xy_from[0]]
         en_passant = self.chessman_en_passant
+        not_moved = getattr(chessman, 'not_moved', None)
+        old_hash = self.hash
+        current_color = self.current_color
+        halfmove_clock = self.halfmove_clock
+        rights = self.castling_rights()
+
+        # Make the "en passant" movement
+        captured_xy = (xy_to[0], xy_to[1])
+        if chessman.CODE == ChessmanPawn.CODE and xy_from[0] != xy_to[0] and \
+                self.board[xy_to[1]][xy_to[0]].CODE == EmptyCell.CODE:
+            captured_xy = (xy_to[0], xy_from[1])
+        captured = self.board[captured_xy[1]][captured_xy[0]]
+        self.halfmove_clock = 0 if chessman.CODE == ChessmanPawn.CODE or captured.color != Color.EMPTY \
+            else halfmove_clock + 1
+        if chessman.color == Color.BLACK:
+            self.fullmove_number += 1
+
+        # Update the hash: the chessman leaves xy_from and comes to xy_to, the captured one leaves the board
+        keys = ZOBRIST_PIECES[chessman.CODE][chessman.color]
+        self.hash ^= keys[xy_from[0] + 8 * xy_from[1]] ^ keys[xy_to[0] + 8 * xy_to[1]]
+        if captured.color != Color.EMPTY:
+            self.hash ^= ZOBRIST_PIECES[captured.CODE][captured.color][captured_xy[0] + 8 * captured_xy[1]]
+            self._rate_add(captured, captured_xy[0], captured_xy[1], -1)
+            self.pieces_left -= 1
+        self._rate_add(chessman, xy_from[0], xy_from[1], -1)
+        self._rate_add(chessman, xy_to[0], xy_to[1])
 
         # Remember if the move was appropriate for "en passant" on the next move
         self.define_en_passant(xy_from, xy_to)
-        self.board[xy_to[1]][xy_to[0]] = self.board[xy_from[1]][xy_from[0]]
+        self.board[captured_xy[1]][captured_xy[0]] = EmptyCell()
+        self.board[xy_to[1]][xy_to[0]] = chessman
+        self.board[xy_from[1]][xy_from[0]] = EmptyCell()
 
         # If it's the rook/King, they can't make a Castling anymore
-        if self.board[xy_to[1]][xy_to[0]].CODE in (ChessmanKing.CODE, ChessmanRook.CODE):
-            self.board[xy_to[1]][xy_to[0]].not_moved = False
-
-        # Make the "en passant" movement
-        if en_passant is None: pass
-        elif (xy_to[1] + (1 if self.board[xy_to[1]][xy_to[0]].color == Color.WHITE else -1),
-              xy_to[0]) \
-                == (en_passant[1], en_passant[0]):
-            captured = (en_passant[1], en_passant[0])
-            self.board[captured[0]][captured[1]] = EmptyCell()
-
-        self.board[xy_from[1]][xy_from[0]] = EmptyCell()
+        if chessman.CODE in (ChessmanKing.CODE, ChessmanRook.CODE):
+            chessman.not_moved = False
+
+        # If it's castling, make sure to move the rook too
+        castling = None
+        if chessman.CODE == ChessmanKing.CODE and xy_to[0] - xy_from[0] in (2, -2):
+            castling = ((7, xy_to[1]), (5, xy_to[1])) if xy_to[0] == 6 else ((0, xy_to[1]), (3, xy_to[1]))
+            rook = self.board[castling[0][1]][castling[0][0]]
+            castling += (rook.not_moved,)
+            rook.not_moved = False
+            self.board[castling[1][1]][castling[1][0]] = rook
+            self.board[castling[0][1]][castling[0][0]] = EmptyCell()
+            keys = ZOBRIST_PIECES[rook.CODE][rook.color]
+            self.hash ^= keys[castling[0][0] + 8 * castling[0][1]] ^ keys[castling[1][0] + 8 * castling[1][1]]
+            self._rate_add(rook, castling[0][0], castling[0][1], -1)
+            self._rate_add(rook, castling[1][0], castling[1][1])
+
+        # The rest of the hash: castling rights, "en passant" file and the color to move
+        self.hash ^= ZOBRIST_CASTLING[rights] ^ ZOBRIST_CASTLING[self.castling_rights()]
+        if en_passant is not None:
+            self.hash ^= ZOBRIST_EN_PASSANT[en_passant[0]]
+        if self.chessman_en_passant is not None:
+            self.hash ^= ZOBRIST_EN_PASSANT[self.chessman_en_passant[0]]
+        self.current_color = chessman.enemy_color()
+        if self.current_color != current_color:
+            self.hash ^= ZOBRIST_BLACK_TO_MOVE
 
         # If it's the pawn, making the move to the final field will turn it into any figure
-        if self.board[xy_to[1]][xy_to[0]].CODE == ChessmanPawn.CODE and \
-                xy_to[1] == (0 if self.board[xy_to[1]][xy_to[0]].color == Color.WHITE else 7):
-            return (captured[1], captured[0]), False, True
-
-        # If it's rooking, make sure to move the rook too
-        if self.board[xy_to[1]][xy_to[0]].CODE == ChessmanKing.CODE:
-            if xy_to[0] - xy_from[0] in (2, -2):
-                return (captured[1], captured[0]), True, False
+        promoted = None
+        if chessman.CODE == ChessmanPawn.CODE and promote_to is not None and \
+                xy_to[1] == (0 if chessman.color == Color.WHITE else 7):
+            promoted = chessman
+            self.pawn_promotion(xy_to, promote_to)
+
+        return (xy_from, xy_to, chessman, captured, captured_xy, en_passant,
+                not_moved, castling, promoted, old_hash, current_color, halfmove_clock)
+
+    def unmake_move(self, undo):
+        """Take back a move made with make_move."""
+        xy_from, xy_to, chessman, captured, captured_xy, en_passant, \
+            not_moved, castling, promoted, old_hash, current_color, halfmove_clock = undo
+        if promoted is not None:
+            self._rate_add(self.board[xy_to[1]][xy_to[0]], xy_to[0], xy_to[1], -1)
+            self._rate_add(promoted, xy_to[0], xy_to[1])
+        if castling is not None:
+            rook = self.board[castling[1][1]][castling[1][0]]
+            rook.not_moved = castling[2]
+            self.board[castling[0][1]][castling[0][0]] = rook
+            self.board[castling[1][1]][castling[1][0]] = EmptyCell()
+            self._rate_add(rook, castling[1][0], castling[1][1], -1)
+            self._rate_add(rook, castling[0][0], castling[0][1])
+        if not_moved is not None:
+            chessman.not_moved = not_moved
+        self._rate_add(chessman, xy_to[0], xy_to[1], -1)
+        self._rate_add(chessman, xy_from[0], xy_from[1])
+        if captured.color != Color.EMPTY:
+            self._rate_add(captured, captured_xy[0], captured_xy[1])
+            self.pieces_left += 1
+        self.board[xy_to[1]][xy_to[0]] = EmptyCell()
+        self.board[captured_xy[1]][captured_xy[0]] = captured
+        self.board[xy_from[1]][xy_from[0]] = chessman
+        self.chessman_en_passant = en_passant
+        self.hash = old_hash
+        self.current_color = current_color
+        self.halfmove_clock = halfmove_clock
+        if chessman.color == Color.BLACK:
+            self.fullmove_number -= 1
 
-        return (captured[1], captured[0]), False, False
+    def move_chessman(self, xy_from, xy_to):
+        """Move a chessman from one position to another (a pawn is left for pawn_promotion).
+           Return 1) Coordinates of a captured piece
+                  2) Is the move a Castling
+                  3) Is the move a pawn promotion"""
+        undo = self.make_move(xy_from, xy_to, None)
+        chessman = undo[2]
+        is_promotion = chessman.CODE == ChessmanPawn.CODE and \
+            xy_to[1] == (0 if chessman.color == Color.WHITE else 7)
+        return undo[4], undo[7] is not None, is_promotion
 
     def define_en_passant(self, xy_from, xy_to):
         if not self.get_chessman(xy_from[0], xy_from[1]).CODE == ChessmanPawn.CODE:
@@ -186,14 +671,46 @@ class Chessboard(object):
                 else 1) == 2:
             self.chessman_en_passant = None
             return
-        self.chessman_en_passant = xy_to
+        self.chessman_en_passant = (xy_to[0], xy_to[1])
 
     def is_empty(self, x, y):
         """Check if a cell on the board is empty."""
         return self.get_chessman(x, y).CODE == 'empty'
 
+    def _rate_add(self, chessman, x, y, sign=1):
+        """Add the chessman at (x, y) to the running sums of rate(), or take it away with sign -1."""
+        self.piece_rates[chessman.color] += sign * chessman.rate(self, x, y)
+        if chessman.CODE == ChessmanPawn.CODE:
+            self.pawn_files[chessman.color][x] += sign
+            self.pawn_hash ^= ZOBRIST_PIECES[ChessmanPawn.CODE][chessman.color][x + 8 * y]
+
+    def reset_rates(self):
+        """Count the running sums of rate() and the chessmen over the whole board."""
+        self.piece_rates = {Color.BLACK: 0, Color.WHITE: 0}
+        self.pawn_files = {Color.BLACK: [0] * 8, Color.WHITE: [0] * 8}
+        self.pawn_hash = 0
+        self.pieces_left = 0
+        for y in range(8):
+            for x in range(8):
+                if not self.is_empty(x, y):
+                    self._rate_add(self.get_chessman(x, y), x, y)
+                    self.pieces_left += 1
+
     def rate(self, color):
-        """Evaluate the board for a given color."""
+        """Evaluate the board for a given color from the running sums."""
+        res = self.pawn_table.probe(self.pawn_hash, color)
+        if res is None:
+            files = self.pawn_files
+            self.pawn_table.store(self.pawn_hash, pawn_structure_rate(files[Color.BLACK]),
+                                  pawn_structure_rate(files[Color.WHITE]))
+            res = pawn_structure_rate(files[color])
+        res += self.piece_rates[color]
+        if self.VALIDATE_RATE:
+            assert res == self.rescan_rate(color), "The running sums of rate() are out of date"
+        return res
+
+    def rescan_rate(self, color):
+        """Evaluate the board for a given color square by square (the debug check of rate())."""
         res = 0
         pawn_x_position = []
         for y in range(8):
@@ -265,19 +782,7 @@ class Chessman(object):
         return []
 
     def get_legal_moves(self, board, x, y):
-        chessman = board.get_chessman(x, y)
-        moves = chessman.get_moves(board, x, y, castling=True) \
-            if chessman.CODE == ChessmanKing.CODE else \
-            chessman.get_moves(board, x, y)
-
-        moves_final = list()
-        for move in moves:
-            self_clone = board.clone()
-            self_clone.move_chessman((x, y), move)
-            king_pos = self_clone.get_king_pos(chessman.color)
-            if not self_clone.is_check(king_pos, chessman.color):
-                moves_final.append(move)
-        return moves_final
+        return board.get_legal_moves(x, y)
 
     def enemy_color(self):
         """Return the color of the enemy."""
@@ -554,46 +1059,797 @@ class ChessmanKnight(Chessman):
         return moves
 
 
+CHESSMAN_CLASSES = {cls.CODE: cls for cls in (ChessmanPawn, ChessmanKnight, ChessmanBishop,
+                                               ChessmanRook, ChessmanQueen, ChessmanKing)}
+LETTER_CODES = {letter: code for code, letter in PIECE_LETTERS.items()}
+
+
+# Fixed-size table of searched positions
+class TranspositionTable(object):
+    """Positions are keyed by the Zobrist hash. Every bucket has two slots: a depth-preferred one, which keeps
+       the deepest result of the current search, and an always-replace one, which takes everything else."""
+    EXACT = 0
+    LOWER = 1
+    UPPER = 2
+    # Bytes per entry: key, score and packed (used flag, bound, depth, generation, move)
+    ENTRY_SIZE = 24
+
+    def __init__(self, size_mb=TT_SIZE_MB):
+        self.size_mb = size_mb
+        self.buckets = max(1, int(size_mb * 1024 * 1024) // (2 * self.ENTRY_SIZE))
+        self.keys = array.array('Q', bytes(8 * 2 * self.buckets))
+        self.scores = array.array('d', bytes(8 * 2 * self.buckets))
+        self.data = array.array('q', bytes(8 * 2 * self.buckets))
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.stores = 0
+
+    def clear(self):
+        """Forget all the positions and reset the counters."""
+        self.__init__(self.size_mb)
+
+    def new_search(self):
+        """Start a new search: entries of the previous ones may be replaced by shallower results."""
+        self.generation = (self.generation + 1) % 64
+
+    def stop_requested(self):
+        """Another search process asks this one to stop (see SharedTranspositionTable)."""
+        return False
+
+    @staticmethod
+    def _pack(depth, bound, generation, move):
+        move_code = 0 if move is None else \
+            1 + (move[0][0] + 8 * move[0][1]) + ((move[1][0] + 8 * move[1][1]) << 6)
+        return 1 | bound << 1 | depth << 3 | generation << 11 | move_code << 17
+
+    @staticmethod
+    def _unpack(data, score):
+        move_code = data >> 17
+        move = None
+        if move_code:
+            move_code -= 1
+            move = ((move_code & 7, move_code >> 3 & 7), (move_code >> 6 & 7, move_code >> 9 & 7))
+        return data >> 3 & 0xFF, score, data >> 1 & 3, move
+
+    def probe(self, key):
+        """Return (depth, score, bound, best move) stored for the position, or None."""
+        i = key % self.buckets * 2
+        for slot in (i, i + 1):
+            data = self.data[slot]
+            if data and self.keys[slot] == key:
+                self.hits += 1
+                return self._unpack(data, self.scores[slot])
+        self.misses += 1
+        if self.data[i] or self.data[i + 1]:
+            self.collisions += 1
+        return None
+
+    def store(self, key, depth, score, bound, move=None):
+        """Save a search result: the deeper or newer one takes the depth-preferred slot,
+           the previous owner of that slot moves to the always-replace slot."""
+        self.stores += 1
+        i = key % self.buckets * 2
+        data = self.data[i]
+        if not data or self.keys[i] == key or depth >= data >> 3 & 0xFF or data >> 11 & 63 != self.generation:
+            if data and self.keys[i] != key:
+                self.keys[i + 1] = self.keys[i]
+                self.scores[i + 1] = self.scores[i]
+                self.data[i + 1] = data
+        else:
+            i += 1
+        self.keys[i] = key
+        self.scores[i] = score
+        self.data[i] = self._pack(depth, bound, self.generation, move)
+
+
+# Transposition table in shared memory, for several search processes at once
+def _attach_shared_memory(name):
+    """Shared memory created by another process."""
+    try:
+        # The creator unlinks the memory, the resource tracker of this process must not do it
+        return multiprocessing.shared_memory.SharedMemory(name, track=False)
+    except TypeError:  # before python 3.13
+        return multiprocessing.shared_memory.SharedMemory(name)
+
+
+class StopFlag(object):
+    """Stop flag of a search split between processes, one byte of multiprocessing.shared_memory."""
+    def __init__(self, name=None):
+        """Create a new flag, or attach to the flag of the name created by another process."""
+        self.owner = name is None
+        if self.owner:
+            self.memory = multiprocessing.shared_memory.SharedMemory(create=True, size=1)
+            self.memory.buf[0] = 0
+        else:
+            self.memory = _attach_shared_memory(name)
+        self.name = self.memory.name
+
+    def set(self):
+        self.memory.buf[0] = 1
+
+    def is_set(self):
+        return self.memory.buf[0] == 1
+
+    def close(self):
+        """Detach from the shared memory, the creator also frees it."""
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class SharedTranspositionTable(TranspositionTable):
+    """The buckets of TranspositionTable in a multiprocessing.shared_memory buffer. The processes write without
+       locks: the key is stored XORed with the score and the data, so an entry torn by two writers doesn't verify
+       and is taken for a miss. The header keeps the stop flag and the generation of the search."""
+    HEADER_SIZE = 8
+
+    def __init__(self, size_mb=TT_SIZE_MB, name=None):
+        """Create a new table, or attach to the table of the name created by another process."""
+        self.size_mb = size_mb
+        self.buckets = max(1, int(size_mb * 1024 * 1024) // (2 * self.ENTRY_SIZE))
+        size = 8 * 2 * self.buckets
+        self.owner = name is None
+        if self.owner:
+            self.memory = multiprocessing.shared_memory.SharedMemory(create=True, size=self.HEADER_SIZE + 3 * size)
+        else:
+            self.memory = _attach_shared_memory(name)
+        self.name = self.memory.name
+        buf = self.memory.buf
+        start = self.HEADER_SIZE
+        self.header = buf[:start]
+        self.keys = buf[start:start + size].cast('Q')
+        self.scores = buf[start + size:start + 2 * size].cast('d')
+        self.score_bits = buf[start + size:start + 2 * size].cast('Q')
+        self.data = buf[start + 2 * size:start + 3 * size].cast('q')
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.stores = 0
+
+    @property
+    def generation(self):
+        return self.header[1]
+
+    def clear(self):
+        """Forget all the positions and reset the counters."""
+        self.memory.buf[:] = bytes(self.memory.size)
+        self.hits = self.misses = self.collisions = self.stores = 0
+
+    def close(self):
+        """Detach from the shared memory, the creator also frees it."""
+        for view in (self.header, self.keys, self.scores, self.score_bits, self.data):
+            view.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def new_search(self):
+        """Start a new search of all the processes, only the creator of the table does it."""
+        if self.owner:
+            self.header[0] = 0
+            self.header[1] = (self.header[1] + 1) % 64
+
+    def request_stop(self):
+        """Ask the other processes to stop the search."""
+        self.header[0] = 1
+
+    def stop_requested(self):
+        return self.header[0] == 1
+
+    def probe(self, key):
+        """Return (depth, score, bound, best move) stored for the position, or None."""
+        i = key % self.buckets * 2
+        for slot in (i, i + 1):
+            data = self.data[slot]
+            score_bits = self.score_bits[slot]
+            if data and self.keys[slot] ^ data ^ score_bits == key:
+                self.hits += 1
+                return self._unpack(data, struct.unpack('d', struct.pack('Q', score_bits))[0])
+        self.misses += 1
+        if self.data[i] or self.data[i + 1]:
+            self.collisions += 1
+        return None
+
+    def _write(self, slot, key, score, data):
+        self.data[slot] = data
+        self.scores[slot] = score
+        self.keys[slot] = key ^ data ^ self.score_bits[slot]
+
+    def store(self, key, depth, score, bound, move=None):
+        """Save a search result, the same replacement as of TranspositionTable."""
+        self.stores += 1
+        i = key % self.buckets * 2
+        data = self.data[i]
+        score_bits = self.score_bits[i]
+        old_key = self.keys[i] ^ data ^ score_bits
+        if not data or old_key == key or depth >= data >> 3 & 0xFF or data >> 11 & 63 != self.generation:
+            if data and old_key != key:
+                self._write(i + 1, old_key, struct.unpack('d', struct.pack('Q', score_bits))[0], data)
+        else:
+            i += 1
+        self._write(i, key, score, self._pack(depth, bound, self.generation, move))
+
+
+# Order in which the AI search tries the moves
+class MoveOrdering(object):
+    """The move of the transposition table goes first, then the captures by most valuable victim /
+       least valuable attacker, then the killer moves of the ply, then the quiet moves by history."""
+    HASH_MOVE = 1 << 30
+    CAPTURE = 1 << 20
+    KILLER = 1 << 19
+    KILLERS_PER_PLY = 2
+    HISTORY_SIZE = 3 * 4096
+    # Copied over the history by clear(), so a new search doesn't allocate the array again
+    _NO_HISTORY = array.array('q', bytes(8 * HISTORY_SIZE))
+
+    def __init__(self):
+        self.killers = []
+        # Cutoff counts of the quiet moves: [color * 4096 + square from * 64 + square to]
+        self.history = array.array('q', self._NO_HISTORY)
+
+    def clear(self):
+        """Forget the killer moves and the history of the previous search."""
+        self.killers = []
+        self.history[:] = self._NO_HISTORY
+
+    @staticmethod
+    def _history_index(color, xy_from, xy_to):
+        return color * 4096 + (xy_from[0] + 8 * xy_from[1]) * 64 + xy_to[0] + 8 * xy_to[1]
+
+    def sort(self, board, moves, color, depth, hash_move=None):
+        """Sort the moves of the color at the depth, the most promising first."""
+        killers = self.killers[depth] if depth < len(self.killers) else ()
+
+        def score(move):
+            xy_from, xy_to = move
+            if move == hash_move:
+                return self.HASH_MOVE
+            if not board.is_empty(*xy_to):
+                return self.CAPTURE + board.get_chessman(*xy_to).VALUE * 100 - board.get_chessman(*xy_from).VALUE
+            if move in killers:
+                return self.KILLER + self.KILLERS_PER_PLY - killers.index(move)
+            return min(self.history[self._history_index(color, xy_from, xy_to)], self.KILLER - 1)
+
+        moves.sort(key=score, reverse=True)
+
+    def cutoff(self, board, move, color, depth, remaining):
+        """Remember the quiet move which refuted the position at the depth."""
+        if not board.is_empty(*move[1]):
+            return
+        while len(self.killers) <= depth:
+            self.killers.append([])
+        killers = self.killers[depth]
+        if move in killers:
+            killers.remove(move)
+        killers.insert(0, move)
+        del killers[self.KILLERS_PER_PLY:]
+        self.history[self._history_index(color, *move)] += remaining * remaining
+
+
+# Counters of one AI search, collected when the AI is made with collect_stats=True
+class SearchStats(object):
+    def __init__(self):
+        self.nodes_per_ply = []
+        self.leaf_evaluations = 0
+        self.clones = 0
+        self.move_generations = 0
+        self.beta_cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.tt_probes = 0
+        self.tt_hits = 0
+        # Seconds from the start of the search to the end of every iteration by depth
+        self.iteration_times = {}
+        self.seconds = 0.0
+
+    def count_node(self, ply):
+        while len(self.nodes_per_ply) <= ply:
+            self.nodes_per_ply.append(0)
+        self.nodes_per_ply[ply] += 1
+
+    @property
+    def nodes(self):
+        return sum(self.nodes_per_ply)
+
+    def first_move_cutoff_rate(self):
+        """Part of the beta cutoffs made by the first move searched, the quality of the move ordering."""
+        return self.first_move_cutoffs / self.beta_cutoffs if self.beta_cutoffs else 0.0
+
+    def tt_hit_rate(self):
+        return self.tt_hits / self.tt_probes if self.tt_probes else 0.0
+
+    def as_dict(self):
+        return {"nodes": self.nodes, "nodes_per_ply": self.nodes_per_ply, "leaf_evaluations": self.leaf_evaluations,
+                "clones": self.clones, "move_generations": self.move_generations, "beta_cutoffs": self.beta_cutoffs,
+                "first_move_cutoff_rate": self.first_move_cutoff_rate(), "tt_probes": self.tt_probes,
+                "tt_hits": self.tt_hits, "tt_hit_rate": self.tt_hit_rate(),
+                "iteration_times": self.iteration_times, "seconds": self.seconds}
+
+    def __str__(self):
+        nps = self.nodes / self.seconds if self.seconds else 0
+        res = f"nodes: {self.nodes} in {self.seconds:.2f}s ({nps:.0f}/s)\n"
+        res += "per ply: " + " ".join(str(nodes) for nodes in self.nodes_per_ply) + "\n"
+        res += f"leaf evaluations: {self.leaf_evaluations}\n"
+        res += f"move generations: {self.move_generations}, clones: {self.clones}\n"
+        res += f"beta cutoffs: {self.beta_cutoffs}, first move: {self.first_move_cutoff_rate():.0%}\n"
+        res += f"TT probes: {self.tt_probes}, hits: {self.tt_hit_rate():.0%}\n"
+        res += "iterations: " + " ".join(f"{depth}:{seconds:.2f}s" for depth, seconds in self.iteration_times.items())
+        return res
+
+
+# Raised inside the search when the time or node budget is spent
+class SearchAborted(Exception):
+    pass
+
+
 class AI(object):
-    def __init__(self, my_color, depth):
+    MATE_RATE = 1000
+    # Rates above it are mates, their distance is counted from the node when stored in the table
+    MATE_BOUND = MATE_RATE - 100
+    # Margin of the search window around a capture bonus, so a rounded bound is never taken for an exact rate
+    WINDOW_EPSILON = 1e-6
+    # The clock is looked at once in so many nodes
+    TIME_CHECK_NODES = 256
+    # The processes searching the root moves are asked to stop so often at most
+    STOP_POLL_SECONDS = 0.02
+    # Captures searched beyond the depth at most
+    QUIESCENCE_PLIES = 8
+    # A capture is skipped when even the captured piece and this margin can't raise the rate up to alpha
+    DELTA_MARGIN = 20
+
+    def __init__(self, my_color, depth, tt: TranspositionTable | None = None,
+                 time_limit: float | None = None, node_limit: int | None = None,
+                 workers: int = 1, executor: concurrent.futures.Executor | None = None,
+                 collect_stats: bool = False, book=None, tablebases=None, on_iteration: Callable | None = None,
+                 ponder: bool = False, stop_flag: StopFlag | None = None):
         self.my_color = my_color
         self.enemy_color = Color.invert(my_color)
         self.depth = depth
+        self.tt = tt if tt is not None else TranspositionTable()
+        self.ordering = MoveOrdering()
+        self.time_limit = time_limit
+        self.node_limit = node_limit
+        # Root moves are split between so many processes of the executor (a new pool when it's None).
+        # With a SharedTranspositionTable the processes search all the moves instead (Lazy SMP)
+        self.workers = workers
+        self.executor = executor
+        # Opening book (book.OpeningBook), its moves are played without a search
+        self.book = book
+        # Endgame tables (tablebase.Tablebases) probed at the root and in the search
+        self.tablebases = tablebases
+        # on_iteration(ai, depth, rates) is called after every completed iteration, to report the progress
+        self.on_iteration = on_iteration
+        # Pondering: the search of the position after the expected enemy move runs without the time limit
+        # until ponderhit(), the enemy thinks meanwhile
+        self.ponder = ponder
+        self._started = None
+        self.search_depth = depth  # depth of the current iteration
+        self.completed_depth = 0
+        self.iterations = {}  # rates of every completed iteration by depth
+        self.iteration_times = {}  # seconds from the start of the search to the end of every iteration by depth
+        # Statistics of the last search if collect_stats is set, else None
+        self.collect_stats = collect_stats
+        self.stats = None
+        self.nodes = 0
+        self._deadline = None
+        # Set by stop() from another thread, the search ends with the last completed iteration
+        self._stopped = False
+        # The flag of the process which has split the root moves, it stops the search the same way
+        self.stop_flag = stop_flag
+
+    def stop(self):
+        """Ask the search running in another thread to end now, the processes searching its root moves too."""
+        self._stopped = True
+
+    def ponderhit(self):
+        """The expected move has been played: the pondering search goes on as a normal one. Its time limit
+           counts from the start of the pondering, so a long enough pondering ends at once."""
+        self.ponder = False
+        if self.time_limit is not None and self._started is not None:
+            self._deadline = self._started + self.time_limit
+
+    def _tt_rate(self, rate, depth, storing):
+        """Turn the mate distance from the root into the distance from the node and back."""
+        shift = depth if storing else -depth
+        if rate > self.MATE_BOUND:
+            return rate + shift
+        if rate < -self.MATE_BOUND:
+            return rate - shift
+        return rate
 
-    def do(self, board, depth=0):
-        enemy = bool(depth % 2)
-        color = self.enemy_color if enemy else self.my_color
-        if depth == self.depth:
-            return board.rate(self.my_color) - board.rate(self.enemy_color)*1.1
-        rates = []
-        for y in range(8):
-            for x in range(8):
-                if board.get_color(x, y) != color:
-                    continue
-                xy_from = [x, y]
-                for xy_to in board.get_chessman_moves(x, y):
-                    new_board = board.clone()
-                    target_cell = new_board.move_chessman(xy_from, xy_to)
-                    captured = target_cell.CODE != 'empty'
-                    if captured and target_cell.CODE == 'king':
-                        rate = -1000 if enemy else 1000  # king capturing
-                    else:
-                        rate = self.do(new_board, depth + 1)
-                        if rate is None:
-                            continue
-                        if captured and not enemy:
-                            rate += self.depth - depth  # a little more aggression
-                    if depth:
-                        rates.append(rate)
-                    else:
-                        rates.append([rate, xy_from, xy_to])
-        if not depth:
-            return rates
-        if not rates:
+    def _check_budget(self):
+        """Stop the search when the node or time budget is spent."""
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchAborted()
+        if not self.nodes % self.TIME_CHECK_NODES and \
+                (self._deadline is not None and time.monotonic() >= self._deadline or self._stopped or
+                 self.stop_flag is not None and self.stop_flag.is_set() or self.tt.stop_requested()):
+            raise SearchAborted()
+
+    def do(self, board, moves=None):
+        """Rate the moves of my_color, the best one first: [[rate, xy_from, xy_to], ...].
+           Searches depth 1, 2, ... up to self.depth while the budget lasts and returns the last
+           completed iteration. The best move gets its exact rate, the others an upper bound of theirs.
+           Only the given root moves are searched if there are any. The statistics are left in self.stats.
+           A move of the opening book is returned alone with the rate 0, completed_depth is 0 then.
+           In a position of the endgame tables the moves are rated by the tables without a search."""
+        if not self.collect_stats:
+            return self._do(board, moves)
+        self.stats = stats = SearchStats()
+        tt_hits, tt_misses, clones = self.tt.hits, self.tt.misses, type(board).clones
+        start = time.perf_counter()
+        rates = self._do(board, moves)
+        stats.seconds = time.perf_counter() - start
+        stats.tt_hits = self.tt.hits - tt_hits
+        stats.tt_probes = stats.tt_hits + self.tt.misses - tt_misses
+        stats.clones = type(board).clones - clones
+        stats.iteration_times = dict(self.iteration_times)
+        return rates
+
+    def _do(self, board, moves):
+        self.tt.new_search()
+        self.nodes = 0
+        self.completed_depth = 0
+        self.iterations = {}
+        self.iteration_times = {}
+        start = time.perf_counter()
+        self._started = time.monotonic()
+        self._deadline = None if self.time_limit is None or self.ponder else self._started + self.time_limit
+        self.ordering.clear()
+        if self.book is not None and moves is None and board.current_color == self.my_color:
+            move = self.book.choose(board)
+            if move is not None:
+                return [[0.0, move[0], move[1]]]
+        if self.tablebases is not None and moves is None:
+            rates = self._probe_root(board)
+            if rates is not None:
+                return rates
+        # A part of the root moves is searched to the end, the other parts may be not decided as quickly
+        partial = moves is not None
+        if moves is None:
+            moves = board.get_all_legal_moves(self.my_color)
+            if self.stats is not None:
+                self.stats.move_generations += 1
+        self.ordering.sort(board, moves, self.my_color, 0)
+        helpers = None
+        if self.workers > 1 and isinstance(self.tt, SharedTranspositionTable):
+            helpers = self._start_helpers(board, moves)
+        # Every process gets two moves at least
+        elif min(self.workers, len(moves) // 2) > 1:
+            return self._do_parallel(board, moves, min(self.workers, len(moves) // 2))
+
+        rates = [[0, xy_from, xy_to] for xy_from, xy_to in moves]
+        try:
+            for search_depth in range(1, self.depth + 1):
+                self.search_depth = search_depth
+                try:
+                    rates = self._search_root(board, rates)
+                except SearchAborted:
+                    break
+                self.completed_depth = search_depth
+                self.iterations[search_depth] = rates
+                self.iteration_times[search_depth] = time.perf_counter() - start
+                if self.on_iteration is not None:
+                    self.on_iteration(self, search_depth, rates)
+                # Nothing to choose from or the outcome is already known
+                if not partial and (len(rates) < 2 or abs(rates[0][0]) > self.MATE_BOUND):
+                    break
+        finally:
+            if helpers is not None:
+                self._stop_helpers(*helpers)
+        return rates
+
+    def _start_helpers(self, board, moves):
+        """Lazy SMP: start processes searching the same position through the shared table, they fill it
+           for this search. Every other one searches a ply deeper, each one starts from another root move."""
+        executor = self.executor if self.executor is not None else \
+            concurrent.futures.ProcessPoolExecutor(self.workers - 1)
+        snapshot = board.snapshot()
+        futures = [executor.submit(_search_helper, type(board), snapshot, self.my_color,
+                                   min(self.depth + i % 2, MAX_THINKING_DEPTH), moves[i:] + moves[:i],
+                                   self.tt.name, self.tt.size_mb, None if self.ponder else self.time_limit)
+                   for i in range(1, self.workers)]
+        return executor, futures
+
+    def _stop_helpers(self, executor, futures):
+        """Stop the Lazy SMP processes and count their nodes in."""
+        self.tt.request_stop()
+        try:
+            self.nodes += sum(future.result() for future in futures)
+        finally:
+            if executor is not self.executor:
+                executor.shutdown()
+
+    def _do_parallel(self, board, moves, parts):
+        """Split the root moves between processes and merge the deepest iteration all of them completed.
+           stop() reaches the processes through a StopFlag, they end with their completed iterations.
+           While pondering they have no time limit, the deadline of ponderhit() stops them."""
+        snapshot = board.snapshot()
+        node_limit = None if self.node_limit is None else self.node_limit // parts
+        executor = self.executor if self.executor is not None else concurrent.futures.ProcessPoolExecutor(parts)
+        stop_flag = StopFlag()
+        try:
+            # The moves are dealt out in the order of promise, so every process gets good and bad ones
+            futures = [executor.submit(_search_root_moves, type(board), snapshot, self.my_color, self.depth,
+                                       moves[i::parts], None if self.ponder else self.time_limit, node_limit,
+                                       stop_flag.name)
+                       for i in range(parts)]
+            pending = futures
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=self.STOP_POLL_SECONDS)
+                if pending and (self._stopped or self._deadline is not None and time.monotonic() >= self._deadline):
+                    stop_flag.set()
+            results = [future.result() for future in futures]
+        finally:
+            stop_flag.close()
+            if executor is not self.executor:
+                executor.shutdown()
+        self.nodes = sum(nodes for iterations, nodes in results)
+        self.completed_depth = min(max(iterations) for iterations, nodes in results)
+        for depth in range(1, self.completed_depth + 1):
+            # Every part has its best move first with the exact rate, the best of them is the best move
+            rates = [rate for iterations, nodes in results for rate in iterations[depth]]
+            rates.sort(key=lambda rate: -rate[0])
+            self.iterations[depth] = rates
+        return self.iterations[self.completed_depth]
+
+    def _probe_root(self, board):
+        """Rate all the moves by the endgame tables, the shortest mate first. None if a move has no table."""
+        if self.tablebases.probe(board) is None:
             return None
-        rate = min(rates) if enemy else max(rates)
+        rates = []
+        for xy_from, xy_to in board.get_all_legal_moves(self.my_color):
+            undo = board.make_move(xy_from, xy_to)
+            try:
+                rate = self.tablebases.rate(board, 1, self.MATE_RATE)
+            finally:
+                board.unmake_move(undo)
+            if rate is None:
+                return None
+            rates.append([-rate, xy_from, xy_to])
+        rates.sort(key=lambda rate: -rate[0])
+        return rates
+
+    def _search_root(self, board, rates):
+        """One iteration: rate the root moves in the order of the previous one, the best move first."""
+        alpha = -math.inf
+        best = None
+        new_rates = []
+        if self.stats is not None:
+            self.stats.count_node(0)
+        for _, xy_from, xy_to in rates:
+            # The first iteration always completes, so there is a move to play
+            rate = self._rate_move(board, 0, xy_from, xy_to, alpha, math.inf,
+                                   self.completed_depth > 0)
+            new_rates.append([rate, xy_from, xy_to])
+            if rate > alpha:
+                alpha, best = rate, new_rates[-1]
+        if best is not None:
+            self.tt.store(board.hash, self.search_depth, alpha, TranspositionTable.EXACT, (best[1], best[2]))
+            new_rates.remove(best)
+            new_rates.sort(key=lambda rate: -rate[0])
+            new_rates.insert(0, best)
+        return new_rates
+
+    def _rate_move(self, board, depth, xy_from, xy_to, alpha, beta, budget=True):
+        """Rate the move for the color to move at the depth, searching the reply with the window."""
+        # A little more aggression: my captures get a bonus of the remaining depth
+        bonus = self.search_depth - depth if not depth % 2 and not board.is_empty(*xy_to) else 0
+        # Play the move on the same board and take it back after the subtree is rated
+        undo = board.make_move(xy_from, xy_to)
+        try:
+            if bonus:
+                rate = -self._search(board, depth + 1, bonus - beta - self.WINDOW_EPSILON,
+                                     bonus - alpha + self.WINDOW_EPSILON, budget)
+                # A mate keeps its distance, the bonus would take it out of the mate rates
+                if abs(rate) <= self.MATE_BOUND:
+                    rate += bonus
+            else:
+                rate = -self._search(board, depth + 1, -beta, -alpha, budget)
+        finally:
+            board.unmake_move(undo)
         return rate
 
+    def _search(self, board, depth, alpha, beta, budget=True):
+        """Negamax alpha-beta search with fail-soft bounds, the rate is for the color to move."""
+        if depth == self.search_depth:
+            return self._quiescence(board, depth, alpha, beta, budget)
+        self.nodes += 1
+        if budget:
+            self._check_budget()
+        stats = self.stats
+        if stats is not None:
+            stats.count_node(depth)
+        if self.tablebases is not None:
+            rate = self.tablebases.rate(board, depth, self.MATE_RATE)
+            if rate is not None:
+                return rate
+        enemy = bool(depth % 2)
+
+        # The same position may have been rated through another order of moves
+        remaining = self.search_depth - depth
+        entry = self.tt.probe(board.hash)
+        if entry is not None and entry[0] >= remaining:
+            rate = self._tt_rate(entry[1], depth, False)
+            if entry[2] == TranspositionTable.EXACT or \
+                    (entry[2] == TranspositionTable.LOWER and rate >= beta) or \
+                    (entry[2] == TranspositionTable.UPPER and rate <= alpha):
+                return rate
+
+        color = self.enemy_color if enemy else self.my_color
+        moves = board.get_all_legal_moves(color)
+        if stats is not None:
+            stats.move_generations += 1
+        if not moves:
+            # No moves: checkmate (the king would be captured) or stalemate
+            if not board.is_check(board.get_king_pos(color), color):
+                return 0
+            return -(self.MATE_RATE - depth)
+
+        self.ordering.sort(board, moves, color, depth, None if entry is None else entry[3])
+        alpha_start = alpha
+        best_rate = -math.inf
+        best_move = None
+        for i, (xy_from, xy_to) in enumerate(moves):
+            rate = self._rate_move(board, depth, xy_from, xy_to, alpha, beta, budget)
+            if rate > best_rate:
+                best_rate, best_move = rate, (xy_from, xy_to)
+                if rate > alpha:
+                    alpha = rate
+                    if alpha >= beta:
+                        self.ordering.cutoff(board, best_move, color, depth, remaining)
+                        if stats is not None:
+                            stats.beta_cutoffs += 1
+                            stats.first_move_cutoffs += not i
+                        break  # the enemy won't let this position happen
+
+        bound = TranspositionTable.UPPER if best_rate <= alpha_start else \
+            TranspositionTable.LOWER if best_rate >= beta else TranspositionTable.EXACT
+        self.tt.store(board.hash, remaining, self._tt_rate(best_rate, depth, True), bound, best_move)
+        return best_rate
+
+    def _quiescence(self, board, depth, alpha, beta, budget=True):
+        """Rate the position once the captures settle: the color to move either stands pat or captures."""
+        self.nodes += 1
+        if budget:
+            self._check_budget()
+        stats = self.stats
+        if stats is not None:
+            stats.count_node(depth)
+            stats.leaf_evaluations += 1
+        if self.tablebases is not None:
+            rate = self.tablebases.rate(board, depth, self.MATE_RATE)
+            if rate is not None:
+                return rate
+        enemy = bool(depth % 2)
+        rate = board.rate(self.my_color) - board.rate(self.enemy_color)*1.1
+        stand_pat = -rate if enemy else rate
+        if stand_pat >= beta or depth - self.search_depth >= self.QUIESCENCE_PLIES:
+            return stand_pat
+
+        color = self.enemy_color if enemy else self.my_color
+        captures = [move for move in board.get_all_legal_moves(color) if not board.is_empty(*move[1])]
+        if stats is not None:
+            stats.move_generations += 1
+        self.ordering.sort(board, captures, color, depth)
+        best_rate = stand_pat
+        alpha = max(alpha, stand_pat)
+        for i, (xy_from, xy_to) in enumerate(captures):
+            # Delta pruning: the capture can't win enough to matter
+            if stand_pat + board.get_chessman(*xy_to).rate(board, *xy_to)*1.1 + self.DELTA_MARGIN <= alpha:
+                continue
+            undo = board.make_move(xy_from, xy_to)
+            try:
+                rate = -self._quiescence(board, depth + 1, -beta, -alpha, budget)
+            finally:
+                board.unmake_move(undo)
+            if rate > best_rate:
+                best_rate = rate
+                if rate > alpha:
+                    alpha = rate
+                    if alpha >= beta:
+                        if stats is not None:
+                            stats.beta_cutoffs += 1
+                            stats.first_move_cutoffs += not i
+                        break
+        return best_rate
+
+
+class SearchTask(object):
+    """A search of AsyncAI running in the background."""
+    def __init__(self, ai: AI, board):
+        self.ai = ai
+        self.board = board
+        self.cancelled = False
+        self.future: concurrent.futures.Future | None = None
+
+    def done(self):
+        return self.future.done()
+
+    def on_done(self, callback: Callable):
+        """Call callback(task, rates) in the search thread when the search ends (at once if it has ended),
+           unless the task is cancelled."""
+        self.future.add_done_callback(
+            lambda future: None if self.cancelled or future.cancelled() else callback(self, future.result()))
+
+    def ponderhit(self, callback: Callable | None = None):
+        """The pondering has guessed the enemy move: finish the search as a normal one, see AI.ponderhit."""
+        self.ai.ponderhit()
+        if callback is not None:
+            self.on_done(callback)
+
+    def stop(self):
+        """Play now: the search ends with the last completed iteration, which is its result."""
+        self.ai.stop()
+
+    def cancel(self):
+        """Drop the search, its result isn't reported."""
+        self.cancelled = True
+        self.ai.stop()
+        self.future.cancel()
+
+    def result(self, timeout=None):
+        """Rates of AI.do, waits for the end of the search."""
+        return self.future.result(timeout)
+
+
+class AsyncAI(object):
+    """Runs the searches of AI in a background thread one after another, so the caller (the event loop of the
+       interface) is never blocked by a search. The board is cloned, the caller may go on using it."""
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="search")
+        self.task: SearchTask | None = None
+
+    def start(self, ai: AI, board, moves=None, on_done: Callable | None = None) -> SearchTask:
+        """Start the search of the position, a search still running is cancelled. on_done(task, rates)
+           is called in the search thread when it ends, unless the task is cancelled."""
+        self.cancel()
+        task = SearchTask(ai, board.clone())
+        task.future = self.executor.submit(ai.do, task.board, moves)
+        if on_done is not None:
+            task.on_done(on_done)
+        self.task = task
+        return task
+
+    def busy(self):
+        return self.task is not None and not self.task.done()
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+
+def _search_root_moves(board_class, snapshot, my_color, depth, moves, time_limit, node_limit, stop_name):
+    """Search a part of the root moves in a worker process until the time limit or the stop flag of the name.
+       Return the rates of every completed iteration by depth and the number of nodes."""
+    board = board_class.from_snapshot(snapshot)
+    stop_flag = StopFlag(stop_name)
+    try:
+        ai = AI(my_color, depth, time_limit=time_limit, node_limit=node_limit, stop_flag=stop_flag)
+        ai.do(board, moves)
+    finally:
+        stop_flag.close()
+    return ai.iterations, ai.nodes
+
+
+def _search_helper(board_class, snapshot, my_color, depth, moves, tt_name, tt_size_mb, time_limit):
+    """Search the position in a Lazy SMP helper process, only to fill the shared table.
+       Return the number of nodes."""
+    board = board_class.from_snapshot(snapshot)
+    tt = SharedTranspositionTable(tt_size_mb, tt_name)
+    try:
+        ai = AI(my_color, depth, tt, time_limit=time_limit)
+        ai.do(board, moves)
+    finally:
+        tt.close()
+    return ai.nodes
+
 
 class Game(object):
     @staticmethod
@@ -609,17 +1865,13 @@ class Game(object):
 
         color = Color.WHITE
         for i in range(22):
-            max_rate = -9999
-            xy_from = xy_to = None
             rates = AI(color, THINKING_DEPTH).do(cb)
-            for rate in rates:
-                if rate[0] < max_rate:
-                    continue
-                max_rate, xy_from, xy_to = rate
-            if not xy_from:
+            if not rates:
                 print('end')
                 exit()
-            cb.move_chessman(xy_from, xy_to)
+            max_rate, xy_from, xy_to = rates[0]
+            if cb.move_chessman(xy_from, xy_to)[2]:
+                cb.pawn_promotion(xy_to, ChessmanQueen.CODE)
             color = Color.invert(color)
             self.clear_screen()
             print(cb)
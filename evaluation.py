@@ -0,0 +1,81 @@
+#! -*- coding: utf-8 -*-
+try:
+    import numpy
+except ImportError as e:
+    # Only the batch evaluation needs NumPy, the rest of the program runs without it
+    raise ImportError(f"{e}\n\nPlease write [\npip install numpy\n] in the command line to use evaluation.py") from e
+
+from libraries import *
+from chess_engine import Color, Chessboard
+from bitboard import KIND_CLASSES, KIND_LETTERS
+
+# Positions are (N, 64) int8 arrays of piece codes by square (x + 8 * y, as in Chessboard.snapshot):
+# 0 - empty, 1..6 - white pawn, knight, bishop, rook, queen, king, -1..-6 - the black ones
+PAWN_CODE = 1
+# Piece code by the letter of a snapshot, every other byte is 0
+CODE_BY_BYTE = numpy.zeros(256, dtype=numpy.int8)
+for _kind, _letter in enumerate(KIND_LETTERS):
+    CODE_BY_BYTE[ord(_letter.upper())] = _kind + 1
+    CODE_BY_BYTE[ord(_letter)] = -_kind - 1
+LETTER_BY_CODE = {0: '.'}
+LETTER_BY_CODE.update({kind + 1: letter.upper() for kind, letter in enumerate(KIND_LETTERS)})
+LETTER_BY_CODE.update({-kind - 1: letter for kind, letter in enumerate(KIND_LETTERS)})
+# Rate of the chessman of every code on every square (at square * 13 + code + 6), taken from the chessman classes.
+# The white rates take the low 32 bits and the black ones the high 32 bits, so one sum adds up both colors
+RATE_TABLE = numpy.zeros(64 * 13, dtype=numpy.int64)
+for _kind, _cls in enumerate(KIND_CLASSES):
+    for _sq in range(64):
+        RATE_TABLE[_sq * 13 + _kind + 7] = _cls(Color.WHITE).rate(None, _sq % 8, _sq // 8)
+        RATE_TABLE[_sq * 13 + 5 - _kind] = _cls(Color.BLACK).rate(None, _sq % 8, _sq // 8) << 32
+SQUARE_OFFSETS = numpy.arange(64, dtype=numpy.intp) * 13 + 6
+
+
+def board_codes(board):
+    """Piece codes of the board (any board class with snapshot()): (64,) int8 array."""
+    return CODE_BY_BYTE[numpy.frombuffer(board.snapshot()[0].encode(), dtype=numpy.uint8)]
+
+
+def boards_to_arrays(boards):
+    """Piece codes and the colors to move of the boards: ((N, 64) int8 array, (N,) int8 array)."""
+    snapshots = [board.snapshot() for board in boards]
+    pieces = numpy.frombuffer(''.join(snapshot[0] for snapshot in snapshots).encode(), dtype=numpy.uint8)
+    codes = CODE_BY_BYTE[pieces].reshape(len(snapshots), 64)
+    return codes, numpy.array([snapshot[3] for snapshot in snapshots], dtype=numpy.int8)
+
+
+def array_to_board(codes, color, board_class=Chessboard):
+    """Board of a row of piece codes with the color to move. The array has no castling rights
+       and en passant, so the kings and rooks are all moved."""
+    pieces = ''.join(LETTER_BY_CODE[int(code)] for code in codes)
+    return board_class.from_snapshot((pieces, 0, None, int(color)))
+
+
+def _pawn_structure_rates(pawns):
+    """pawn_structure_rate() of the (N, 64) bool arrays of the pawns of one color."""
+    # The rows are added up as 64-bit numbers, a byte of the sum is the number of pawns on its file
+    files = pawns.view(numpy.uint64).sum(axis=1, dtype=numpy.uint64).view(numpy.uint8).reshape(-1, 8)
+    files = files.astype(numpy.int64)
+    # double pawns reduce the rate
+    res = 2 * ((files > 0).sum(axis=1) - files.sum(axis=1))
+    # alone pawn reduce the rate, as in pawn_structure_rate() only on the files b..f
+    alone = (files[:, 1:6] > 0) & (files[:, 0:5] == 0) & (files[:, 2:7] == 0)
+    return res - 2 * alone.sum(axis=1)
+
+
+def rates(codes):
+    """Chessboard.rate() of both colors: ((N,) black rates, (N,) white rates)."""
+    codes = numpy.asarray(codes, dtype=numpy.int8).reshape(-1, 64)
+    both = RATE_TABLE.take(codes + SQUARE_OFFSETS).sum(axis=1)
+    black = (both >> 32) + _pawn_structure_rates(codes == -PAWN_CODE)
+    white = (both & 0xFFFFFFFF) + _pawn_structure_rates(codes == PAWN_CODE)
+    return black, white
+
+
+def evaluate(codes, colors):
+    """Leaf rate of the AI search for the color to move of every position: rate(my) - rate(enemy)*1.1.
+       The float operations are the same as in AI, so the results are equal to its ones exactly."""
+    black, white = rates(codes)
+    white_to_move = numpy.asarray(colors).reshape(-1) == Color.WHITE
+    my = numpy.where(white_to_move, white, black)
+    enemy = numpy.where(white_to_move, black, white)
+    return my - enemy * 1.1
@@ -0,0 +1,187 @@
+#! -*- coding: utf-8 -*-
+from libraries import *
+from chess_engine import START_FEN
+from bitboard import BitboardChessboard
+from perft import move_name, parse_move_name
+import pgn
+
+GAMES_FILE = "games.db"
+# Games are written to the file in transactions of so many games by import_pgn
+IMPORT_BATCH = 1000
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    white TEXT, black TEXT, result TEXT, date TEXT,
+    start_fen TEXT NOT NULL,
+    moves TEXT NOT NULL,
+    plies INTEGER NOT NULL,
+    headers TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS positions (
+    hash INTEGER NOT NULL,
+    game_id INTEGER NOT NULL,
+    ply INTEGER NOT NULL,
+    PRIMARY KEY (hash, game_id, ply)
+) WITHOUT ROWID;
+"""
+
+
+def _key(position_hash):
+    """The 64-bit hash as the signed integer of SQLite."""
+    return position_hash - (1 << 64) if position_hash >= 1 << 63 else position_hash
+
+
+class GameDatabase(object):
+    """Games in a SQLite file with an index of every position they reach: (hash, game id, ply).
+       The positions are stored sorted by the hash, so a position is found by one lookup of the index
+       however many games there are, and a game is replayed only up to the ply which is asked for."""
+    def __init__(self, filename=GAMES_FILE):
+        self.filename = filename
+        # The interface calls the database from the threads of its event handlers, one at a time
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def _insert(self, moves, hashes, headers, start_fen):
+        """Store the game of the moves (xy_from, xy_to, promote_to) and the hashes of its positions from the start
+           without a commit, return its id."""
+        cursor = self.connection.execute(
+            "INSERT INTO games (white, black, result, date, start_fen, moves, plies, headers) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (headers.get('White'), headers.get('Black'), headers.get('Result', '*'), headers.get('Date'),
+             start_fen, ' '.join(move_name(*move) for move in moves), len(moves), json.dumps(headers)))
+        game_id = cursor.lastrowid
+        # A position met twice in a game (a repetition) is stored at both plies
+        self.connection.executemany("INSERT INTO positions VALUES (?, ?, ?)",
+                                    [(_key(position_hash), game_id, ply) for ply, position_hash in enumerate(hashes)])
+        return game_id
+
+    def add_game(self, moves, headers=None, start_fen=START_FEN):
+        """Store a game of the moves [(xy_from, xy_to, promote_to), ...] from the position, return its id."""
+        board = BitboardChessboard.from_fen(start_fen)
+        hashes = [board.hash]
+        for move in moves:
+            board.make_move(*move)
+            hashes.append(board.hash)
+        with self.connection:
+            return self._insert(moves, hashes, headers or {}, start_fen)
+
+    def import_pgn(self, source, limit=None):
+        """Store the games of a PGN file (a file name or an open text file), the games with illegal moves are
+           skipped. Return (stored, skipped)."""
+        stored = skipped = 0
+        try:
+            for game in pgn.read_games(source):
+                moves = []
+                hashes = [BitboardChessboard.from_fen(game.start_fen()).hash]
+                try:
+                    for ply, move, board in game.replay():
+                        moves.append(move)
+                        hashes.append(board.hash)
+                except ValueError:
+                    skipped += 1
+                    continue
+                headers = dict(game.headers)
+                headers.setdefault('Result', game.result)
+                self._insert(moves, hashes, headers, game.start_fen())
+                stored += 1
+                if stored % IMPORT_BATCH == 0:
+                    self.connection.commit()
+                if limit and stored >= limit:
+                    break
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        return stored, skipped
+
+    def find_position(self, position, limit=None):
+        """Games which reach the position (a board or its hash): [(game id, ply), ...] by the game id."""
+        key = _key(position if isinstance(position, int) else position.hash)
+        query = "SELECT game_id, ply FROM positions WHERE hash = ? ORDER BY game_id"
+        if limit:
+            return self.connection.execute(query + " LIMIT ?", (key, limit)).fetchall()
+        return self.connection.execute(query, (key,)).fetchall()
+
+    def continuations(self, position):
+        """Moves played in the position by the stored games: [(move name, games), ...], the most played first."""
+        key = _key(position if isinstance(position, int) else position.hash)
+        counts = {}
+        for moves, ply in self.connection.execute(
+                "SELECT games.moves, positions.ply FROM positions JOIN games ON games.id = positions.game_id "
+                "WHERE positions.hash = ? AND positions.ply < games.plies", (key,)):
+            name = moves.split(' ', ply + 1)[ply]
+            counts[name] = counts.get(name, 0) + 1
+        return sorted(counts.items(), key=lambda item: -item[1])
+
+    def recent(self, limit=10):
+        """Last stored games: [(id, white, black, result, date, plies), ...], the newest first."""
+        return self.connection.execute(
+            "SELECT id, white, black, result, date, plies FROM games ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+
+    def game(self, game_id):
+        """Tags, start position and moves of a game: (headers, start FEN, [(xy_from, xy_to, promote_to), ...])."""
+        row = self.connection.execute("SELECT headers, start_fen, moves FROM games WHERE id = ?", (game_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No game {game_id}")
+        return json.loads(row[0]), row[1], [parse_move_name(name) for name in row[2].split()]
+
+    def load(self, game_id, ply=None, board_class=BitboardChessboard):
+        """Board of the game after the ply (the end of the game by default), to continue the game from there."""
+        headers, start_fen, moves = self.game(game_id)
+        board = board_class.from_fen(start_fen)
+        for move in moves[:ply]:
+            board.make_move(*move)
+        return board
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Store games and find the games which reach a position.")
+    parser.add_argument("--database", default=GAMES_FILE, help="the SQLite file of the games")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="store the games of a PGN file")
+    import_parser.add_argument("file", help="the PGN file")
+    import_parser.add_argument("--games", type=int, help="stop after so many games")
+    find_parser = commands.add_parser("find", help="list the games which reach a position")
+    find_parser.add_argument("--fen", help="the position, the start position by default")
+    find_parser.add_argument("--limit", type=int, default=20, help="games to list")
+    find_parser.add_argument("moves", nargs="*", help="moves from the position, e2e4 e7e5 ...")
+    list_parser = commands.add_parser("list", help="list the last stored games")
+    list_parser.add_argument("--limit", type=int, default=20, help="games to list")
+    args = parser.parse_args(args)
+
+    database = GameDatabase(args.database)
+    start = time.perf_counter()
+    if args.command == "import":
+        stored, skipped = database.import_pgn(args.file, args.games)
+        print(f"{stored} games stored, {skipped} skipped in {time.perf_counter() - start:.1f}s, "
+              f"{len(database)} games in {args.database}")
+    elif args.command == "find":
+        board = BitboardChessboard.from_fen(args.fen or START_FEN)
+        for name in args.moves:
+            board.make_move(*parse_move_name(name))
+        found = database.find_position(board)
+        seconds = time.perf_counter() - start
+        for game_id, ply in found[:args.limit]:
+            headers, start_fen, moves = database.game(game_id)
+            print(f"#{game_id} ply {ply}: {headers.get('White', '?')} - {headers.get('Black', '?')} "
+                  f"{headers.get('Result', '*')}")
+        print(f"{len(found)} games reach the position ({seconds * 1000:.1f}ms)")
+        for name, games in database.continuations(board)[:10]:
+            print(f"{name}  {games:>6}")
+    else:
+        for game_id, white, black, result, date, plies in database.recent(args.limit):
+            print(f"#{game_id} {white or '?'} - {black or '?'} {result or '*'} {date or ''} {plies} plies")
+    database.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,21 @@
 try:
+    import argparse
+    import array
+    import concurrent.futures
     import copy
     import json
     import math
+    import mmap
+    import multiprocessing.shared_memory
+    import os
+    import random
+    import re
+    import sqlite3
+    import struct
+    import sys
+    import threading
+    import time
+    import tracemalloc
     from typing import Callable
 
     import flet
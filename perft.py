@@ -0,0 +1,147 @@
+#! -*- coding: utf-8 -*-
+from libraries import *
+from chess_engine import Chessboard, ChessmanPawn
+from bitboard import BitboardChessboard
+
+# Chessmen a pawn may turn into on the last rank
+PROMOTIONS = ('queen', 'rook', 'bishop', 'knight')
+
+# Reference positions (FEN) with the known move path counts for depth 1, 2, ...
+REFERENCE_POSITIONS = {
+    "start": ("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+              [20, 400, 8902, 197281, 4865609]),
+    # Castling, en passant, promotions and pins all at once
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+                 [48, 2039, 97862, 4085603]),
+    "rook endgame": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+                     [14, 191, 2812, 43238, 674624]),
+    "promotions and checks": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+                              [6, 264, 9467, 422333]),
+    "discovered checks": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 0 1",
+                          [44, 1486, 62379, 2103487]),
+    "middlegame": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 1",
+                   [46, 2079, 89890, 3894594]),
+    # The pawn which has just moved two squares may be taken en passant
+    "en passant": ("8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1",
+                   [15, 126, 1928, 13931]),
+    # Taking en passant would open the rank to the king
+    "en passant pin": ("3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1",
+                       [18, 92, 1670, 10138]),
+    "castling under attack": ("r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1",
+                              [44, 1494, 50509, 1720476]),
+    "under-promotions": ("n1n5/PPPk4/8/8/8/8/4Kppp/5N1N b - - 0 1",
+                         [24, 496, 9483, 182838]),
+}
+
+BOARD_CLASSES = {"Bitboard": BitboardChessboard, "Classic": Chessboard}
+
+
+def move_name(xy_from, xy_to, promote_to=None):
+    """Coordinate notation of a move: e2e4, e7e8q."""
+    res = ''
+    for x, y in (xy_from, xy_to):
+        res += 'abcdefgh'[x] + str(8 - y)
+    if promote_to is not None:
+        res += 'n' if promote_to == 'knight' else promote_to[0]
+    return res
+
+
+def parse_move_name(name):
+    """Move of the coordinate notation: (xy_from, xy_to, promote_to). Raise ValueError if it isn't one."""
+    name = name.strip().lower()
+    if len(name) not in (4, 5) or any(name[i] not in 'abcdefgh' for i in (0, 2)) \
+            or any(name[i] not in '12345678' for i in (1, 3)) or (len(name) == 5 and name[4] not in 'qrbn'):
+        raise ValueError(f"Not a move: {name!r}")
+    xy_from = ('abcdefgh'.index(name[0]), 8 - int(name[1]))
+    xy_to = ('abcdefgh'.index(name[2]), 8 - int(name[3]))
+    promote_to = None
+    if len(name) == 5:
+        promote_to = 'knight' if name[4] == 'n' else next(p for p in PROMOTIONS if p[0] == name[4])
+    return xy_from, xy_to, promote_to
+
+
+def _moves(board):
+    """Legal moves of the color to move with every promotion: (xy_from, xy_to, promote_to)."""
+    moves = []
+    for xy_from, xy_to in board.get_all_legal_moves(board.current_color):
+        if xy_to[1] in (0, 7) and board.get_chessman(*xy_from).CODE == ChessmanPawn.CODE:
+            moves += [(xy_from, xy_to, promote_to) for promote_to in PROMOTIONS]
+        else:
+            moves.append((xy_from, xy_to, None))
+    return moves
+
+
+def perft(board, depth):
+    """Count the move paths of the depth from the position."""
+    moves = _moves(board)
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for xy_from, xy_to, promote_to in moves:
+        undo = board.make_move(xy_from, xy_to, promote_to)
+        nodes += perft(board, depth - 1)
+        board.unmake_move(undo)
+    return nodes
+
+
+def divide(board, depth):
+    """Count the move paths of the depth after every move: {move name: nodes}."""
+    res = {}
+    for xy_from, xy_to, promote_to in _moves(board):
+        undo = board.make_move(xy_from, xy_to, promote_to)
+        res[move_name(xy_from, xy_to, promote_to)] = perft(board, depth - 1)
+        board.unmake_move(undo)
+    return res
+
+
+def run_suite(board_class=BitboardChessboard, max_depth=3, names=None):
+    """Run perft on the reference positions up to max_depth.
+       Return a list of dicts: position, depth, nodes, expected, ok, seconds, nps."""
+    results = []
+    for name, (fen, counts) in REFERENCE_POSITIONS.items():
+        if names and name not in names:
+            continue
+        for depth in range(1, min(max_depth, len(counts)) + 1):
+            board = board_class.from_fen(fen)
+            start = time.perf_counter()
+            nodes = perft(board, depth)
+            seconds = time.perf_counter() - start
+            results.append({"position": name, "depth": depth, "nodes": nodes, "expected": counts[depth - 1],
+                            "ok": nodes == counts[depth - 1], "seconds": seconds,
+                            "nps": nodes / seconds if seconds else 0.0})
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Check the move generator against the reference move counts.")
+    parser.add_argument("--depth", type=int, default=3, help="the deepest perft to run")
+    parser.add_argument("--board", choices=BOARD_CLASSES, default="Bitboard", help="the board engine to check")
+    parser.add_argument("--position", action="append", choices=REFERENCE_POSITIONS,
+                        help="a reference position to run (all of them by default)")
+    parser.add_argument("--divide", action="store_true",
+                        help="count the paths after every move of the positions instead")
+    args = parser.parse_args(args)
+    board_class = BOARD_CLASSES[args.board]
+
+    if args.divide:
+        for name in args.position or REFERENCE_POSITIONS:
+            board = board_class.from_fen(REFERENCE_POSITIONS[name][0])
+            counts = divide(board, args.depth)
+            print(f"{name}, depth {args.depth}:")
+            for move, nodes in sorted(counts.items()):
+                print(f"  {move}: {nodes}")
+            print(f"  total: {sum(counts.values())}")
+        return 0
+
+    results = run_suite(board_class, args.depth, args.position)
+    for res in results:
+        print(f"{res['position']:<24} depth {res['depth']}  {res['nodes']:>9} of {res['expected']:>9}  "
+              f"{'OK  ' if res['ok'] else 'FAIL'}  {res['seconds']:8.3f}s  {res['nps']:10.0f} nodes/s")
+    nodes = sum(res['nodes'] for res in results)
+    seconds = sum(res['seconds'] for res in results)
+    print(f"total {nodes} nodes in {seconds:.3f}s, {nodes / seconds if seconds else 0:.0f} nodes/s")
+    return 0 if all(res['ok'] for res in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
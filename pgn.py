@@ -0,0 +1,198 @@
+#! -*- coding: utf-8 -*-
+from libraries import *
+from chess_engine import Color, ChessmanPawn, ChessmanKing, START_FEN
+from bitboard import BitboardChessboard
+
+# SAN letters of the chessmen, a move without one is a pawn move
+SAN_PIECES = {'N': 'knight', 'B': 'bishop', 'R': 'rook', 'Q': 'queen', 'K': 'king'}
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+# Characters which start or end the comments and the variations of the movetext
+_SPECIAL = re.compile(r'[{}();]')
+
+
+def parse_san(board, san):
+    """Move of the color to move in SAN (e4, Nbd7, exd6, O-O, e8=Q+): (xy_from, xy_to, promote_to).
+       Raise ValueError if it isn't a legal move or it is ambiguous."""
+    color = board.current_color
+    text = san.rstrip('+#!?')
+    if text in ('O-O', 'O-O-O', '0-0', '0-0-0'):
+        y = 7 if color == Color.WHITE else 0
+        xy_to = (6 if len(text) == 3 else 2, y)
+        king = board.get_chessman(4, y)
+        if king.CODE != ChessmanKing.CODE or king.color != color or list(xy_to) not in board.get_legal_moves(4, y):
+            raise ValueError(f"Illegal move: {san}")
+        return (4, y), xy_to, None
+    if text.endswith('e.p.'):
+        text = text[:-4]
+    promote_to = None
+    if len(text) > 2 and text[-1] in SAN_PIECES and text[0] not in SAN_PIECES:
+        promote_to = SAN_PIECES[text[-1]]
+        text = text[:-2] if text[-2] == '=' else text[:-1]
+    code = ChessmanPawn.CODE
+    if text and text[0] in SAN_PIECES:
+        code = SAN_PIECES[text[0]]
+        text = text[1:]
+    text = text.replace('x', '').replace('-', '')
+    if len(text) < 2 or text[-2] not in 'abcdefgh' or text[-1] not in '12345678':
+        raise ValueError(f"Not a move: {san}")
+    xy_to = ('abcdefgh'.index(text[-2]), 8 - int(text[-1]))
+    # Disambiguation: the file and/or the rank of the chessman, a pawn which doesn't capture stays on the file
+    hint = text[:-2]
+    from_x = 'abcdefgh'.index(hint[0]) if hint and hint[0] in 'abcdefgh' else None
+    from_y = 8 - int(hint[-1]) if hint and hint[-1] in '12345678' else None
+    if code == ChessmanPawn.CODE and from_x is None:
+        from_x = xy_to[0]
+    found = []
+    for x, y in board.get_positions(color, code):
+        if (from_x is not None and x != from_x) or (from_y is not None and y != from_y):
+            continue
+        # Only the chessmen which may reach the square at all are checked for the legal moves
+        dx, dy = abs(xy_to[0] - x), abs(xy_to[1] - y)
+        if code == 'knight' and dx * dy != 2 or code == 'bishop' and dx != dy or \
+                code == 'rook' and dx and dy or code == 'queen' and dx and dy and dx != dy:
+            continue
+        if list(xy_to) in board.get_legal_moves(x, y):
+            found.append((x, y))
+    if len(found) != 1:
+        raise ValueError(f"{'Ambiguous' if found else 'Illegal'} move: {san}")
+    if code == ChessmanPawn.CODE and xy_to[1] in (0, 7) and promote_to is None:
+        promote_to = 'queen'
+    return found[0], xy_to, promote_to
+
+
+class PgnGame(object):
+    """A game of a PGN file: the tags, the moves in SAN and the result."""
+    def __init__(self):
+        self.headers = {}
+        self.moves = []
+        self.result = '*'
+
+    def start_fen(self):
+        return self.headers.get('FEN', START_FEN)
+
+    def replay(self, board_class=BitboardChessboard, snapshots=False):
+        """Play the moves from the start position, yield (ply, (xy_from, xy_to, promote_to), board) after
+           every move. The same board is yielded every time, or its snapshot if snapshots is True.
+           Raise ValueError on a move which isn't legal."""
+        board = board_class.from_fen(self.start_fen())
+        for ply, san in enumerate(self.moves, 1):
+            move = parse_san(board, san)
+            board.make_move(*move)
+            yield ply, move, board.snapshot() if snapshots else board
+
+
+class _MovetextScanner(object):
+    """Cleans the movetext of the comments and the variations, which may go on over several lines."""
+    def __init__(self):
+        self.in_comment = False
+        self.depth = 0
+
+    def clean(self, line):
+        if not self.in_comment and not self.depth and not _SPECIAL.search(line):
+            return line
+        res = []
+        pos = 0
+        for match in _SPECIAL.finditer(line):
+            char, i = match.group(), match.start()
+            if self.in_comment:
+                if char == '}':
+                    self.in_comment = False
+                    if not self.depth:
+                        pos = i + 1
+                continue
+            if char == ';':
+                # The rest of the line is a comment
+                if not self.depth:
+                    res.append(line[pos:i])
+                return ' '.join(res)
+            if char in '{(':
+                if not self.depth:
+                    res.append(line[pos:i])
+                if char == '{':
+                    self.in_comment = True
+                else:
+                    self.depth += 1
+            elif char == ')' and self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    pos = i + 1
+        if not self.in_comment and not self.depth:
+            res.append(line[pos:])
+        return ' '.join(res)
+
+
+def _header(line):
+    """Tag and value of a tag pair line: [Event "..."]."""
+    tag, _, value = line.strip()[1:-1].partition(' ')
+    value = value.strip()
+    if value.startswith('"') and value.endswith('"'):
+        value = value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return tag, value
+
+
+def read_games(source):
+    """Stream the games of a PGN file (a file name or an open text file) one by one, the file is read line by line."""
+    if isinstance(source, str):
+        with open(source, encoding='utf-8-sig', errors='replace') as file:
+            yield from read_games(file)
+        return
+    game = PgnGame()
+    scanner = _MovetextScanner()
+    started = False
+    for line in source:
+        if line.startswith('%'):
+            continue
+        if line.startswith('[') and not scanner.in_comment and not scanner.depth:
+            # Tags after some moves start the next game, if the result was missing
+            if game.moves:
+                yield game
+                game = PgnGame()
+            tag, value = _header(line)
+            game.headers[tag] = value
+            started = True
+            continue
+        for token in scanner.clean(line).split():
+            if token in RESULTS:
+                game.result = token
+                yield game
+                game = PgnGame()
+                scanner = _MovetextScanner()
+                started = False
+                break
+            if token[0].isdigit() and not token.startswith('0-0'):
+                # Move number, maybe glued to the move: 12. 12... 12.e4
+                token = token.lstrip('0123456789').lstrip('.')
+            if not token or token[0] in '$!?':
+                continue
+            game.moves.append(token)
+            started = True
+    if started:
+        yield game
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Replay the games of a PGN file and count the moves.")
+    parser.add_argument("file", help="the PGN file")
+    parser.add_argument("--games", type=int, help="stop after so many games")
+    args = parser.parse_args(args)
+
+    games = moves = errors = 0
+    start = time.perf_counter()
+    for game in read_games(args.file):
+        try:
+            for ply, move, board in game.replay():
+                moves += 1
+        except ValueError as e:
+            errors += 1
+            print(f"Game {games + 1}: {e}", file=sys.stderr)
+        games += 1
+        if args.games and games >= args.games:
+            break
+    seconds = time.perf_counter() - start
+    print(f"{games} games, {moves} moves, {errors} errors in {seconds:.1f}s, "
+          f"{moves / seconds if seconds else 0:.0f} moves/s")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
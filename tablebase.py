@@ -0,0 +1,256 @@
+#! -*- coding: utf-8 -*-
+from libraries import *
+from chess_engine import Color, ChessmanKing, PIECE_LETTERS
+from bitboard import BitboardChessboard
+from perft import BOARD_CLASSES
+
+TABLEBASE_DIR = "resources/tablebases"
+TABLE_EXTENSION = ".tb"
+# Tables by name and the letter of the piece next to the two kings.
+# KPK needs the tables of the promotions, so it goes last
+TABLES = {"KQK": 'q', "KRK": 'r', "KPK": 'p'}
+PROMOTION_TABLES = ("KQK", "KRK")
+# A table has a byte for every position: side to move (0 - the side with the piece), its king, the lone king, the piece.
+# The piece side is always white in the index, the positions where it is black are mirrored
+TABLE_SIZE = 2 * 64 * 64 * 64
+MAX_PIECES = 3
+
+
+def table_index(piece_side_to_move, king, lone_king, piece):
+    return (((0 if piece_side_to_move else 1) * 64 + king) * 64 + lone_king) * 64 + piece
+
+
+def _encode(win, plies):
+    """Byte of a table: 0 - draw, plies to mate if the side to move wins, -plies - 1 if it loses."""
+    return plies if win else -plies - 1
+
+
+def _decode(value):
+    """Result for the side to move and plies to mate: (1 - win, 0 - draw, -1 - loss, plies)."""
+    if value > 127:
+        value -= 256
+    if not value:
+        return 0, 0
+    return (1, value) if value > 0 else (-1, -value - 1)
+
+
+class Tablebase(object):
+    """Table of one piece set in a memory-mapped file, the pages are shared by all the processes."""
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            if os.fstat(file.fileno()).st_size != TABLE_SIZE:
+                raise ValueError(f"{filename} is not an endgame table")
+            self.memory = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def probe(self, index):
+        return _decode(self.memory[index])
+
+    def close(self):
+        self.memory.close()
+
+
+class Tablebases(object):
+    """The endgame tables found in the directory, probed by the search."""
+    def __init__(self, directory=TABLEBASE_DIR):
+        self.tables = {}
+        for name, letter in TABLES.items():
+            filename = os.path.join(directory, name + TABLE_EXTENSION)
+            if os.path.exists(filename):
+                self.tables[letter] = Tablebase(filename)
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.tables)
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+
+    def probe(self, board):
+        """Result of the position for the color to move: (1 - win, 0 - draw, -1 - loss, plies to mate),
+           None if there is no table of the position."""
+        if board.piece_count() > MAX_PIECES:
+            return None
+        pieces = board.pieces()
+        if len(pieces) == 2:
+            # Two kings
+            self.hits += 1
+            return 0, 0
+        if board.castling_rights():
+            return None
+        king = lone_king = piece = table = None
+        for x, y, color, code in pieces:
+            if code != ChessmanKing.CODE:
+                table = self.tables.get(PIECE_LETTERS[code])
+                piece, side = (x, y), color
+        if table is None:
+            return None
+        for x, y, color, code in pieces:
+            if code == ChessmanKing.CODE:
+                if color == side:
+                    king = (x, y)
+                else:
+                    lone_king = (x, y)
+        squares = [x + 8 * (y if side == Color.WHITE else 7 - y) for x, y in (king, piece, lone_king)]
+        self.hits += 1
+        return table.probe(table_index(board.current_color == side, squares[0], squares[2], squares[1]))
+
+    def rate(self, board, depth, mate_rate):
+        """Rate of the position for the color to move as the search rates the mates at the depth, None without a table."""
+        res = self.probe(board)
+        if res is None:
+            return None
+        result, plies = res
+        return result * (mate_rate - depth - plies)
+
+
+def _setup(board_class, letter, index):
+    """Board of the table position or None if the position is illegal."""
+    piece = index % 64
+    lone_king = index // 64 % 64
+    king = index // 4096 % 64
+    piece_to_move = index < TABLE_SIZE // 2
+    if king == lone_king or king == piece or lone_king == piece:
+        return None
+    if abs(king % 8 - lone_king % 8) <= 1 and abs(king // 8 - lone_king // 8) <= 1:
+        return None
+    if letter == 'p' and piece // 8 in (0, 7):
+        return None
+    pieces = ['.'] * 64
+    pieces[king], pieces[piece], pieces[lone_king] = 'K', letter.upper(), 'k'
+    color = Color.WHITE if piece_to_move else Color.BLACK
+    board = board_class.from_snapshot((''.join(pieces), 0, None, color))
+    # The side which has just moved can't be in check
+    other = Color.invert(color)
+    if board.is_check(board.get_king_pos(other), other):
+        return None
+    return board
+
+
+def generate(name, directory=TABLEBASE_DIR, board_class=BitboardChessboard):
+    """Compute the table by retrograde analysis and write it to the directory. The moves come from the board
+       class, the positions are decided backwards from the mates ply by ply. Return the longest mate in plies."""
+    letter = TABLES[name]
+    promotions = [Tablebase(os.path.join(directory, table + TABLE_EXTENSION))
+                  for table in PROMOTION_TABLES] if letter == 'p' else []
+    values = array.array('b', bytes(TABLE_SIZE))
+    decided = bytearray(TABLE_SIZE)
+    # Moves of every position which aren't known to lose yet
+    remaining = bytearray(TABLE_SIZE)
+    edges_from = array.array('i')
+    edges_to = array.array('i')
+    # Positions won through a promotion by the ply
+    events = {}
+    level = []
+
+    for index in range(TABLE_SIZE):
+        board = _setup(board_class, letter, index)
+        if board is None:
+            continue
+        color = board.current_color
+        moves = board.get_all_legal_moves(color)
+        if not moves:
+            if board.is_check(board.get_king_pos(color), color):
+                decided[index] = 1
+                values[index] = _encode(False, 0)
+                level.append(index)
+            continue
+        remaining[index] = len(moves)
+        piece_to_move = color == Color.WHITE
+        piece = index % 64
+        lone_king = index // 64 % 64
+        king = index // 4096 % 64
+        for xy_from, xy_to in moves:
+            sq_from, sq_to = xy_from[0] + 8 * xy_from[1], xy_to[0] + 8 * xy_to[1]
+            if not piece_to_move:
+                # Taking the piece leaves the kings alone: a draw, the move never loses
+                if sq_to != piece:
+                    edges_from.append(index)
+                    edges_to.append(table_index(True, king, sq_to, piece))
+            elif sq_from == king:
+                edges_from.append(index)
+                edges_to.append(table_index(False, sq_to, lone_king, piece))
+            elif letter == 'p' and sq_to < 8:
+                # A promotion wins if the queen or the rook wins, the bishop and the knight still draw
+                best = None
+                for table in promotions:
+                    result, plies = table.probe(table_index(False, king, lone_king, sq_to))
+                    if result < 0 and (best is None or plies < best):
+                        best = plies
+                if best is not None:
+                    events.setdefault(best + 1, []).append(index)
+            else:
+                edges_from.append(index)
+                edges_to.append(table_index(False, king, lone_king, sq_to))
+    for table in promotions:
+        table.close()
+
+    # Predecessors of every position in one array, starts[index]:starts[index + 1] of it
+    starts = array.array('i', bytes(4 * (TABLE_SIZE + 1)))
+    for index in edges_to:
+        starts[index + 1] += 1
+    for index in range(TABLE_SIZE):
+        starts[index + 1] += starts[index]
+    predecessors = array.array('i', bytes(4 * len(edges_to)))
+    filled = starts[:-1]
+    for index_from, index_to in zip(edges_from, edges_to):
+        predecessors[filled[index_to]] = index_from
+        filled[index_to] += 1
+    del edges_from, edges_to, filled
+
+    ply = 0
+    longest = 0
+    while level or any(event_ply > ply for event_ply in events):
+        ply += 1
+        # A position which has a move to a lost one wins, a position all the moves of which go to won ones loses
+        win = ply % 2 == 1
+        next_level = []
+        for index in level:
+            for i in range(starts[index], starts[index + 1]):
+                previous = predecessors[i]
+                if decided[previous]:
+                    continue
+                if not win:
+                    remaining[previous] -= 1
+                    if remaining[previous]:
+                        continue
+                decided[previous] = 1
+                values[previous] = _encode(win, ply)
+                next_level.append(previous)
+        for index in events.pop(ply, []):
+            if not decided[index]:
+                decided[index] = 1
+                values[index] = _encode(True, ply)
+                next_level.append(index)
+        if next_level:
+            longest = ply
+        level = next_level
+    if longest > 126:
+        raise ValueError(f"{name}: the mates are too long for the table")
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name + TABLE_EXTENSION), 'wb') as file:
+        file.write(values.tobytes())
+    return longest
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Generate the endgame tables of the AI search.")
+    parser.add_argument("--table", action="append", choices=TABLES, help="a table to generate (all of them by default)")
+    parser.add_argument("--board", choices=BOARD_CLASSES, default="Bitboard", help="the board engine of the moves")
+    parser.add_argument("--directory", default=TABLEBASE_DIR, help="where to write the tables")
+    args = parser.parse_args(args)
+
+    for name in TABLES:
+        if args.table and name not in args.table:
+            continue
+        start = time.perf_counter()
+        longest = generate(name, args.directory, BOARD_CLASSES[args.board])
+        print(f"{name}: the longest mate in {longest} plies, {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
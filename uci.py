@@ -0,0 +1,290 @@
+#! -*- coding: utf-8 -*-
+from libraries import *
+from chess_engine import AI, AsyncAI, TranspositionTable, SharedTranspositionTable, Color, ChessmanPawn, \
+    START_FEN, MAX_THINKING_DEPTH, TT_SIZE_MB
+from bitboard import BitboardChessboard
+from perft import BOARD_CLASSES, move_name, parse_move_name
+
+ENGINE_NAME = "Classic Chess"
+ENGINE_AUTHOR = "Leonid Abdrakhmanov, Miras Nuraly"
+MAX_HASH_MB = 1024
+MAX_THREADS = os.cpu_count() or 1
+# The clock is shared as if so many moves were left when the GUI doesn't say it
+MOVES_TO_GO = 30
+# Seconds kept for sending the move
+MOVE_OVERHEAD = 0.05
+
+# Positions the search must rate as mates: FEN, depth, UCI score. The first mate is a capture,
+# which gets the capture bonus of the search
+MATE_CHECKS = [
+    ("r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4", 2, "mate 1"),
+    ("6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1", 2, "mate 1"),
+    ("6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1", 4, "mate 1"),
+]
+
+
+def move_time(remaining, increment=0.0, moves_to_go=None):
+    """Seconds of the search of a move by the clock: a share of the remaining time and most of the increment,
+       but never more than a half of the remaining time."""
+    seconds = remaining / (moves_to_go or MOVES_TO_GO) + 0.8 * increment
+    return max(0.01, min(seconds, remaining / 2) - MOVE_OVERHEAD)
+
+
+def uci_score(rate):
+    """Rate of the search in UCI: cp <centipawns> or mate <moves>, negative if the side to move is mated."""
+    if abs(rate) > AI.MATE_BOUND:
+        moves = (AI.MATE_RATE - abs(rate) + 1) // 2
+        return f"mate {int(moves if rate > 0 else -moves)}"
+    return f"cp {round(rate * 100 / ChessmanPawn.VALUE)}"
+
+
+def uci_move(board, xy_from, xy_to):
+    """Move of the search in the coordinate notation, a pawn on the last rank becomes a queen as in make_move."""
+    promote_to = None
+    if xy_to[1] in (0, 7) and board.get_chessman(*xy_from).CODE == ChessmanPawn.CODE:
+        promote_to = 'queen'
+    return move_name(xy_from, xy_to, promote_to)
+
+
+def principal_variation(board, tt, xy_from, xy_to, depth):
+    """Best line from the root move: the moves stored in the table for the positions after it.
+       The board is left as it was."""
+    undos = []
+    line = []
+    move = (xy_from, xy_to)
+    try:
+        while move is not None and len(line) < depth:
+            if move not in board.get_all_legal_moves(board.current_color):
+                break
+            line.append(uci_move(board, *move))
+            undos.append(board.make_move(*move))
+            entry = tt.probe(board.hash)
+            move = entry[3] if entry is not None else None
+    finally:
+        for undo in reversed(undos):
+            board.unmake_move(undo)
+    return line
+
+
+def check_mates(board_class=BitboardChessboard):
+    """Search the positions of MATE_CHECKS and print the scores, return the number of wrong ones."""
+    failures = 0
+    for fen, depth, expected in MATE_CHECKS:
+        board = board_class.from_fen(fen)
+        rates = AI(board.current_color, depth).do(board)
+        score = uci_score(rates[0][0])
+        print(f"{fen:<70} depth {depth}  {score:<8} {'OK' if score == expected else 'FAIL, expected ' + expected}")
+        failures += score != expected
+    return failures
+
+
+class UciEngine(object):
+    """UCI protocol on top of the board and AI. The commands are read by the calling thread and the search
+       runs in the thread of AsyncAI, so isready and stop are answered while it searches."""
+    def __init__(self, board_class=BitboardChessboard, output=sys.stdout):
+        self.board_class = board_class
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.board = board_class.from_fen(START_FEN)
+        self.hash_mb = TT_SIZE_MB
+        self.threads = 1
+        self.tt = TranspositionTable(self.hash_mb)
+        # The rates of the table are from the side of the color which searched, see go()
+        self.tt_color = None
+        self.executor = None
+        self.search = AsyncAI()
+        # go infinite and go ponder: the best move is sent only after stop (or ponderhit)
+        self.infinite = False
+        self.pending = None
+        self.commands = {
+            "uci": self.uci, "isready": self.isready, "ucinewgame": self.ucinewgame, "setoption": self.setoption,
+            "position": self.position, "go": self.go, "stop": self.stop, "ponderhit": self.ponderhit,
+        }
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def handle(self, line):
+        """Run a command line, return False on quit."""
+        words = line.split()
+        if not words:
+            return True
+        if words[0] == "quit":
+            return False
+        command = self.commands.get(words[0])
+        if command is None:
+            self.send(f"info string unknown command {words[0]}")
+        else:
+            try:
+                command(words[1:])
+            except ValueError as e:
+                self.send(f"info string {e}")
+        return True
+
+    def close(self):
+        self.search.shutdown()
+        if self.executor is not None:
+            self.executor.shutdown()
+        if isinstance(self.tt, SharedTranspositionTable):
+            self.tt.close()
+
+    def uci(self, args):
+        self.send(f"id name {ENGINE_NAME}")
+        self.send(f"id author {ENGINE_AUTHOR}")
+        self.send(f"option name Hash type spin default {TT_SIZE_MB} min 1 max {MAX_HASH_MB}")
+        self.send(f"option name Threads type spin default 1 min 1 max {MAX_THREADS}")
+        self.send("option name Ponder type check default false")
+        self.send("uciok")
+
+    def isready(self, args):
+        self.send("readyok")
+
+    def ucinewgame(self, args):
+        self.search.cancel()
+        self.tt.clear()
+        self.tt_color = None
+
+    def _new_table(self):
+        """Table and process pool of the Hash and Threads options. Several threads search the same position
+           through a SharedTranspositionTable (Lazy SMP), so stop ends them all at once."""
+        self.search.cancel()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if isinstance(self.tt, SharedTranspositionTable):
+            self.tt.close()
+        if self.threads > 1:
+            self.tt = SharedTranspositionTable(self.hash_mb)
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.threads - 1)
+        else:
+            self.tt = TranspositionTable(self.hash_mb)
+        self.tt_color = None
+
+    def setoption(self, args):
+        text = ' '.join(args)
+        if not text.startswith("name "):
+            raise ValueError(f"setoption without a name: {text}")
+        name, _, value = text[5:].partition(" value ")
+        name = name.strip().lower()
+        if name == "hash":
+            self.hash_mb = min(max(int(value), 1), MAX_HASH_MB)
+        elif name == "threads":
+            self.threads = min(max(int(value), 1), MAX_THREADS)
+        elif name == "ponder":
+            # The GUI decides when to ponder by go ponder
+            return
+        else:
+            raise ValueError(f"unknown option {name}")
+        self._new_table()
+
+    def position(self, args):
+        """position startpos | fen <FEN> [moves <move> ...]"""
+        moves = args.index("moves") if "moves" in args else len(args)
+        if args and args[0] == "fen":
+            board = self.board_class.from_fen(' '.join(args[1:moves]))
+        else:
+            board = self.board_class.from_fen(START_FEN)
+        for name in args[moves + 1:]:
+            xy_from, xy_to, promote_to = parse_move_name(name)
+            if (xy_from, xy_to) not in board.get_all_legal_moves(board.current_color):
+                raise ValueError(f"illegal move {name}")
+            board.make_move(xy_from, xy_to, promote_to or 'queen')
+        self.board = board
+
+    def go(self, args):
+        """go [depth N] [nodes N] [movetime ms] [wtime ms] [btime ms] [winc ms] [binc ms] [movestogo N] [infinite]
+           [ponder]. A pondering search gets the time of the move counted from the start of the pondering,
+           so after ponderhit it answers at once if it has pondered longer than that."""
+        params = {}
+        for i, word in enumerate(args):
+            if word in ("depth", "nodes", "movetime", "wtime", "btime", "winc", "binc", "movestogo") \
+                    and i + 1 < len(args):
+                params[word] = int(args[i + 1])
+        ponder = "ponder" in args
+        self.infinite = "infinite" in args or ponder
+        self.pending = None
+        depth = min(params.get("depth", MAX_THINKING_DEPTH), MAX_THINKING_DEPTH)
+        time_limit = None
+        white = self.board.current_color == Color.WHITE
+        remaining = params.get("wtime" if white else "btime")
+        if "movetime" in params:
+            time_limit = max(params["movetime"] / 1000 - MOVE_OVERHEAD, 0.01)
+        elif remaining is not None and "infinite" not in args:
+            time_limit = move_time(remaining / 1000, params.get("winc" if white else "binc", 0) / 1000,
+                                   params.get("movestogo"))
+        if self.board.current_color != self.tt_color:
+            # The search rates the positions from the side of its color, the other side's rates don't fit
+            self.search.cancel()
+            self.tt.clear()
+            self.tt_color = self.board.current_color
+        board = self.board.clone()
+        start = time.perf_counter()
+
+        def on_iteration(ai, depth, rates):
+            seconds = time.perf_counter() - start
+            pv = principal_variation(board, self.tt, rates[0][1], rates[0][2], depth)
+            self.send(f"info depth {depth} score {uci_score(rates[0][0])} nodes {ai.nodes} "
+                      f"nps {int(ai.nodes / seconds) if seconds else 0} time {int(seconds * 1000)} pv {' '.join(pv)}")
+
+        ai = AI(self.board.current_color, depth, self.tt, time_limit=time_limit, node_limit=params.get("nodes"),
+                workers=self.threads, executor=self.executor, on_iteration=on_iteration, ponder=ponder)
+        self.search.start(ai, self.board, on_done=self._search_done)
+
+    def _search_done(self, task, rates):
+        if not rates:
+            move = "0000"
+        else:
+            # The expected reply goes with the move, the GUI may let the engine ponder on it
+            pv = principal_variation(task.board, self.tt, rates[0][1], rates[0][2], 2) or \
+                [uci_move(task.board, rates[0][1], rates[0][2])]
+            move = pv[0] + (f" ponder {pv[1]}" if len(pv) > 1 else "")
+        with self.output_lock:
+            if self.infinite:
+                # Kept until stop
+                self.pending = move
+                return
+        self.send(f"bestmove {move}")
+
+    def _release(self, finish):
+        """Send the best move kept by go infinite or go ponder, or finish(task) the search which is still running."""
+        task = self.search.task
+        if task is None:
+            return
+        with self.output_lock:
+            self.infinite = False
+            move, self.pending = self.pending, None
+        if move is not None:
+            self.send(f"bestmove {move}")
+        else:
+            finish(task)
+
+    def stop(self, args):
+        self._release(lambda task: task.stop())
+
+    def ponderhit(self, args):
+        self._release(lambda task: task.ponderhit())
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run the engine under the UCI protocol on stdin and stdout.")
+    parser.add_argument("--board", choices=BOARD_CLASSES, default="Bitboard", help="the board engine")
+    parser.add_argument("--check", action="store_true", help="check the mate scores of the search and exit")
+    args = parser.parse_args(args)
+
+    if args.check:
+        return 1 if check_mates(BOARD_CLASSES[args.board]) else 0
+
+    engine = UciEngine(BOARD_CLASSES[args.board])
+    try:
+        for line in sys.stdin:
+            if not engine.handle(line):
+                break
+    finally:
+        engine.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())